@@ -4,26 +4,43 @@ Created by scj643 on 10/13/2017
 Modified by Brandon Tolbird
 """
 
+import time
+
+# when the interpreter got here, the cold start timings logged for every route count from this
+STARTED = time.time()
+
 import os
-import m3u8
 import math
 import routing
-import time
+import threading
 import xbmc
 import xbmcaddon
 import xbmcplugin
 import xbmcgui
 
 from datetime import datetime
-from resources.lib.vrvlib import VRV
+from resources.lib.vrvlib import VRV, VRVResponse, ART_TARGETS, vrv_json_hook
+from resources.lib.vrvstore import CredentialStore, IndexCache
+from resources.lib.httpcache import ResponseCache
+from resources.lib.artcache import ArtCache
+from resources.lib.catalog import Catalog, Crawler
+from resources.lib.listingcache import ListingCache
+from resources.lib.vrvservice import RemoteVRV
+from resources.lib.vrvplay import VRVPlayer
+from resources.lib.playheads import PlayheadStore, PlayheadSync
+from resources.lib.hls import VariantCache, select_variant, probe_segment
+from resources.lib.throughput import ThroughputMeter
 from xbmcgui import ListItem, Dialog
 from string import capwords
 from urllib import quote_plus, urlencode
 
-from sub_conv import convert_subs
+# sub_conv (pyvtt) is imported by the function that converts subtitles
 
 plugin = routing.Plugin()
 
+# nothing in the plugin reads the raw response dictionaries, don't keep them around
+VRVResponse.keep_raw = False
+
 _plugId = "plugin.video.vrv"
 
 __plugin__ = "VRV"
@@ -60,6 +77,17 @@ username, password = __settings__.getSetting('vrv_username'), \
 adaptive = (__settings__.getSetting('adaptive_mode') == 'true')
 set_res = int(__settings__.getSetting('resolution'))
 do_cache = (__settings__.getSetting('do_cache') == 'true')
+art_cache_bytes = int(float(__settings__.getSetting('art_cache_mb') or 100) * 1024 * 1024)
+art_scale = (0.5, 1.0, 1.5)[int(__settings__.getSetting('art_size') or 1)]
+art_targets = dict((atype, int(width * art_scale)) for atype, width in ART_TARGETS.items())
+art_resize = (__settings__.getSetting('art_resize') == 'true')
+api_cache = (__settings__.getSetting('api_cache') == 'true')
+api_cache_ttl = int(float(__settings__.getSetting('api_cache_hours') or 24) * 3600)
+use_catalog = (__settings__.getSetting('use_catalog') == 'true')
+stale_listings = (__settings__.getSetting('stale_listings') == 'true')
+use_service = (__settings__.getSetting('use_service') == 'true')
+probe_bandwidth = (__settings__.getSetting('probe_bandwidth') == 'true')
+cache_listings = (__settings__.getSetting('cache_listings') == 'true')
 
 vtt_font_name = __settings__.getSetting('font_name')
 vtt_font_size = __settings__.getSetting('font_size')
@@ -68,24 +96,182 @@ vtt_strip_dialogue = (__settings__.getSetting('strip_dialogue') == 'true')
 vtt_sub_offset = int(__settings__.getSetting('sub_offset'))
 
 
-if not (username and password):
-    dialog = Dialog()
-    dialog.notification("VRV", "Username(email) and password not set. Check login under settings.", time=1000, sound=False)
+# seconds from STARTED each route should be done in, by the first part of its path
+ROUTE_BUDGETS = {
+    '': 0.5,
+    'add_to_watchlist': 0.5,
+    'delete_from_watchlist': 0.5,
+    'notavail': 0.2,
+    'episode': 2.0,
+    'movie': 2.0,
+}
+DEFAULT_ROUTE_BUDGET = 1.5
+
+# seconds a rendered listing is replayed from the listing cache, by route function
+# listings missing here, like the watchlist and search results, are always built fresh
+# movie listings carry signed subtitle urls that run out, so they aren't kept either
+LISTING_TTLS = {
+    'channels': 86400,
+    'channel': 86400,
+    'chseries': 3600,
+    'chmovies': 3600,
+    'feeds': 1800,
+    'feed': 1800,
+    'season': 3600,
+}
+
+# seconds playheads read from the API are shown in listings without asking again
+PLAYHEAD_CACHE_AGE = 600
+
+# Kodi content type and sort methods of listings, by route function, the first sort method is the default
+# routes missing here list plain videos in the order the API returned them
+DEFAULT_LISTING_VIEW = ('videos', (xbmcplugin.SORT_METHOD_UNSORTED, xbmcplugin.SORT_METHOD_LABEL))
+LISTING_VIEWS = {
+    'index': (None, ()),
+    'channels': (None, (xbmcplugin.SORT_METHOD_LABEL,)),
+    'channel': (None, ()),
+    'notavail': (None, ()),
+    'chseries': ('tvshows', (xbmcplugin.SORT_METHOD_UNSORTED, xbmcplugin.SORT_METHOD_LABEL)),
+    'chmovies': ('movies', (xbmcplugin.SORT_METHOD_UNSORTED, xbmcplugin.SORT_METHOD_LABEL)),
+    'movie_listing': ('movies', (xbmcplugin.SORT_METHOD_UNSORTED, xbmcplugin.SORT_METHOD_LABEL)),
+    'season': ('episodes', (xbmcplugin.SORT_METHOD_EPISODE, xbmcplugin.SORT_METHOD_LABEL)),
+}
+
+# seconds spent on imports and building the session, see log_startup
+timings = {'imports': time.time() - STARTED}
+
+
+class Lazy(object):
+    """
+    Stands in for what build returns and builds it on first use, so routes only pay for what they touch
+    """
+
+    def __init__(self, build):
+        self.__dict__['_build'] = build
+        # worker threads may touch the object first, only one of them builds it
+        self.__dict__['_lock'] = threading.Lock()
+
+    @property
+    def built(self):
+        """
+        :return: True once something touched the object, checking doesn't build it
+        """
+        return '_value' in self.__dict__
+
+    def _target(self):
+        if '_value' not in self.__dict__:
+            with self._lock:
+                if '_value' not in self.__dict__:
+                    self.__dict__['_value'] = self._build()
+        return self.__dict__['_value']
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._target(), name, value)
+
+    def __nonzero__(self):
+        return bool(self._target())
+
+
+def build_response_cache():
+    if api_cache:
+        return ResponseCache(os.path.join(__profile__, 'responses.db'),
+                             ttls=dict((rclass, api_cache_ttl) for rclass in
+                                       ('series', 'movie_listing', 'movie', 'channel', 'core.channel')))
+    return None
+
+
+def build_session():
+    started = time.time()
+    if not (username and password):
+        dialog = Dialog()
+        dialog.notification("VRV", "Username(email) and password not set. Check login under settings.", time=1000, sound=False)
+
+    vrv_session = None
+    if use_service and username and password:
+        # borrow the login of the background service, its warm session makes the CMS requests
+        vrv_session = RemoteVRV.connect(os.path.join(__profile__, 'service.json'), username, password,
+                                        __settings__.getSetting('oauth_key'),
+                                        __settings__.getSetting('oauth_secret'),
+                                        cache=response_cache)
+        if vrv_session is None:
+            my_log("Background service not available, logging in directly", xbmc.LOGDEBUG)
+
+    if vrv_session is None:
+        vrv_session = VRV(__settings__.getSetting('vrv_username'),
+                          __settings__.getSetting('vrv_password'),
+                          __settings__.getSetting('oauth_key'),
+                          __settings__.getSetting('oauth_secret'),
+                          store=CredentialStore(os.path.join(__profile__, 'credentials.json')),
+                          index_cache=IndexCache(os.path.join(__profile__, 'index_cache.json')),
+                          cache=response_cache)
+
+    if not vrv_session.logged_in:
+        dialog = Dialog()
+        dialog.notification("VRV", "Login failed. Check login under settings.", time=1000, sound=False)
+    elif catalog:
+        vrv_session.memo.catalog = catalog
+    timings['session'] = time.time() - started
+    return vrv_session
+
+
+def build_catalog():
+    if use_catalog:
+        return Catalog(os.path.join(__profile__, 'catalog.db'))
+    return None
+
+
+def build_listing_cache():
+    if cache_listings:
+        return ListingCache(os.path.join(__profile__, 'listings.db'))
+    return None
+
+
+def build_art_cache():
+    if do_cache:
+        # session.http would build the session, only art that is really downloaded needs it
+        return ArtCache(artwork_temp, lambda: session.http(), max_bytes=art_cache_bytes, resize=art_resize)
+    return None
 
-session = VRV(__settings__.getSetting('vrv_username'),
-              __settings__.getSetting('vrv_password'),
-              __settings__.getSetting('oauth_key'),
-              __settings__.getSetting('oauth_secret'))
 
-if not session.logged_in:
-    dialog = Dialog()
-    dialog.notification("VRV", "Login failed. Check login under settings.", time=1000, sound=False)
+def build_playhead_store():
+    return PlayheadStore(os.path.join(__profile__, 'playheads.db'))
 
 
-if session and session.logged_in:
-    cms_url = session.index.links['cms_index.v2'].rstrip('index')
+def build_variant_cache():
+    return VariantCache(os.path.join(__profile__, 'variants.json'))
 
 
+def build_throughput():
+    return ThroughputMeter(os.path.join(__profile__, 'throughput.json'))
+
+
+response_cache = Lazy(build_response_cache)
+session = Lazy(build_session)
+catalog = Lazy(build_catalog)
+art_cache = Lazy(build_art_cache)
+listing_cache = Lazy(build_listing_cache)
+playhead_store = Lazy(build_playhead_store)
+variant_cache = Lazy(build_variant_cache)
+throughput = Lazy(build_throughput)
+
+
+def log_startup():
+    """
+    Log how long the route took from interpreter start, louder when it went over its budget
+    """
+    total = time.time() - STARTED
+    route = plugin.path.strip('/').split('/')[0]
+    budget = ROUTE_BUDGETS.get(route, DEFAULT_ROUTE_BUDGET)
+    session_time = timings.get('session', 0)
+    message = "cold start for {}: imports {:.0f}ms, session {:.0f}ms, route {:.0f}ms, total {:.0f}ms " \
+              "(budget {:.0f}ms)".format(plugin.path, timings['imports'] * 1000, session_time * 1000,
+                                         (total - timings['imports'] - session_time) * 1000, total * 1000,
+                                         budget * 1000)
+    my_log(message, xbmc.LOGNOTICE if total > budget else xbmc.LOGDEBUG)
+
 
 def format_time(seconds):
     secs, mins = math.modf(float(seconds) / float(60))
@@ -94,45 +280,255 @@ def format_time(seconds):
     return "%02d:%02d" % (mins, secs)
 
 
+def play_head_title(title, iph):
+    if iph:
+        if iph.completion_status:
+            title = u"{} [Status: Completed]".format(title)
+        else:
+            title = u"{} [Status: In Progress: {}]".format(title, format_time(iph.position))
+    return title
+
+
+# art urls of parents already seen during this run, keyed like session.memo
+parent_art = dict()
+
+
 def get_parent_art(item):
+    """
+    :return: the art dictionary of the item's series or movie listing, with urls that still need cache_art
+    """
     art_dict = {}
     if (item.rclass == 'episode' or item.rclass == 'season') and item.series_id:
-        parent = session.get_cms(cms_url + 'series/' + item.series_id)
-        if parent.images:
-            art_dict = cache_art(parent.images.kodi_setart_dict())
+        key = ('series', item.series_id)
     elif (item.rclass == 'movie') and item.listing_id:
-        parent = session.get_cms(cms_url + 'movie_listings/' + item.listing_id)
-        if parent.images:
-            art_dict = cache_art(parent.images.kodi_setart_dict())
-    return art_dict
+        key = ('movie_listings', item.listing_id)
+    else:
+        return art_dict
+    if key not in parent_art:
+        parent = session.memo.get(*key)
+        if getattr(parent, 'images', None):
+            art_dict = parent.images.kodi_setart_dict(art_targets)
+        parent_art[key] = art_dict
+    return dict(parent_art[key])
 
 
 def get_parent_info(item):
     info = {}
     if (item.rclass == 'season') and item.series_id:
-        parent = session.get_cms(cms_url + 'series/' + item.series_id)
+        parent = session.memo.series(item.series_id)
         info = parent.kodi_info()
     return info
 
 
 def cache_art(art_dict):
-    if do_cache:
-        for atype, url in art_dict.items():
-            filename = os.path.join(artwork_temp, atype + '_' + '_'.join(url.split('/')[-2:]))
-            if not os.path.exists(filename):
-                image_res = session.session.get(url)
-                if image_res.status_code == 200:
-                    image_file = open(filename, 'wb')
-                    image_file.write(image_res.content)
-                    image_file.close()
-                    art_dict[atype] = filename
-            else:
-                art_dict[atype] = filename
+    if art_cache:
+        art_dict = art_cache.cache_dict(art_dict, art_targets)
     return art_dict
 
+
+def cache_arts(art_dicts):
+    """
+    cache_art for every entry of a listing at once, all missing images download in parallel
+    """
+    if art_cache:
+        art_dicts = art_cache.cache_dicts(art_dicts, art_targets)
+    return art_dicts
+
+
+def item_art(item):
+    """
+    :return: the item's own art with the fanart of its parent, urls still need cache_art
+    """
+    art = item.images.kodi_setart_dict(art_targets) if getattr(item, 'images', None) else {}
+    parent_fanart = get_parent_art(item).get('fanart')
+    if parent_fanart:
+        art['fanart'] = parent_fanart
+    return art
+
+
+def get_play_heads(content_ids):
+    """
+    :return: dictionary of content id to PlayHead, from the local playhead table where it is recent enough and
+        from the API for the rest
+    """
+    if not content_ids:
+        return {}
+    play_heads = playhead_store.get(content_ids, PLAYHEAD_CACHE_AGE)
+    missing = [content_id for content_id in content_ids if content_id not in play_heads]
+    if missing:
+        fetched = session.get_play_heads(missing)
+        # only ids the API answered for, a failed request says nothing about the others
+        playhead_store.remember(list(fetched), fetched)
+        play_heads.update(fetched)
+    return dict((content_id, play_head) for content_id, play_head in play_heads.items() if play_head)
+
+
+def flush_play_heads():
+    """
+    Send playhead updates left over from earlier runs in the background
+    """
+    if playhead_store.due():
+        threading.Thread(target=PlayheadSync(playhead_store, session).flush).start()
+
+
+def list_item(entry, play_heads, art):
+    """
+    :param entry: dictionary made by Directory.add
+    :param play_heads: dictionary of content id to PlayHead for the entries' playhead status
+    :param art: the entry's art with cached files in place of the urls, see cache_arts
+    :return: the (url, ListItem, isFolder) tuple for addDirectoryItems
+    """
+    label = entry['label']
+    if entry.get('playhead'):
+        label = play_head_title(label, play_heads.get(entry['playhead']))
+    li = ListItem(label)
+    if entry.get('label2') is not None:
+        li.setLabel2(entry['label2'])
+    if art:
+        li.setArt(art)
+    if entry.get('info'):
+        li.setInfo('video', entry['info'])
+    for name, value in (entry.get('properties') or {}).items():
+        li.setProperty(name, value)
+    if entry.get('menu'):
+        li.addContextMenuItems([tuple(item) for item in entry['menu']])
+    if entry.get('subtitles'):
+        li.setSubtitles(entry['subtitles'])
+    return entry['url'], li, entry['folder']
+
+
+class Directory(object):
+    """
+    Collects the entries of a listing and hands them to Kodi in one addDirectoryItems call
+    Entries are plain dictionaries, so a finished listing can go into the listing cache and be replayed
+    without touching the API. Playhead status is never stored, it is looked up whenever entries are emitted.
+    """
+
+    def __init__(self, key=None, ttl=0, content=None, sort_methods=()):
+        """
+        :param key: listing cache key, see open_directory
+        :param ttl: seconds the finished listing is kept in the listing cache, 0 to not keep it
+        :param content: Kodi content type of the listing
+        :param sort_methods: xbmcplugin.SORT_METHOD_* the listing offers, the first is the default
+        """
+        self.key = key
+        self.ttl = ttl
+        self.content = content
+        self.sort_methods = sort_methods
+        self.entries = []
+
+    def add(self, url, label, folder=True, transient=False, **fields):
+        """
+        :param fields: label2, info, art (urls, cached on emit), properties, menu, subtitles
+            and playhead (content id the label gets the playhead status of)
+        :param transient: leave the entry out of the listing cache
+        """
+        entry = dict(fields, url=url, label=label, folder=folder)
+        if transient:
+            entry['transient'] = True
+        self.entries.append(entry)
+        return entry
+
+    def replay(self):
+        """
+        Emit the listing from the listing cache
+        :return: True if it was there
+        """
+        if not (self.key and self.ttl and listing_cache):
+            return False
+        entries = listing_cache.get(self.key)
+        if entries is None:
+            return False
+        my_log("Replaying cached listing {}".format(self.key), xbmc.LOGDEBUG)
+        self.entries = entries
+        self.finish(store=False)
+        return True
+
+    def finish(self, store=True):
+        """
+        Emit the entries, store them in the listing cache and end the directory
+        """
+        kept = [entry for entry in self.entries if not entry.get('transient')]
+        if store and kept and self.key and self.ttl and listing_cache:
+            listing_cache.put(self.key, kept, self.ttl)
+        play_heads = get_play_heads([entry['playhead'] for entry in self.entries if entry.get('playhead')])
+        arts = cache_arts([entry.get('art') or {} for entry in self.entries])
+        items = [list_item(entry, play_heads, art) for entry, art in zip(self.entries, arts)]
+        if self.content:
+            xbmcplugin.setContent(plugin.handle, self.content)
+        for method in self.sort_methods:
+            xbmcplugin.addSortMethod(plugin.handle, method)
+        xbmcplugin.addDirectoryItems(plugin.handle, items, len(items))
+        xbmcplugin.endOfDirectory(plugin.handle)
+
+
+def open_directory(route, *args):
+    """
+    :param route: route function whose listing is being built
+    :param args: path arguments of the route, its query arguments come from plugin.args
+    :return: a Directory keyed by the route's url, kept in the listing cache if the route has a ttl
+    """
+    key = ListingCache.key(plugin.url_for(route, *args), plugin.args)
+    content, sort_methods = LISTING_VIEWS.get(route.__name__, DEFAULT_LISTING_VIEW)
+    return Directory(key, LISTING_TTLS.get(route.__name__, 0), content, sort_methods)
+
+# catalog listings older than this many seconds are refreshed in the background in stale listing mode
+STALE_CATALOG_AGE = 900
+# seconds other plugin runs leave a listing alone once one started refreshing it
+REFRESH_CLAIM = 300
+
+# ages in seconds of the cached data the current listing is built from
+listing_ages = []
+
+
+def listing_get(path, fetch=None):
+    """
+    Load a listing, in stale listing mode straight from the response cache while it is revalidated
+    in the background
+    :param fetch: function loading path, defaults to session.get_cms
+    """
+    if stale_listings and response_cache:
+        result, age = session.get_stale(path, fetch)
+        if age is not None:
+            listing_ages.append(age)
+        return result
+    return (fetch or session.get_cms)(path)
+
+
+def revalidate_catalog(updated, kind, entity_id):
+    """
+    In stale listing mode, refresh the catalog listing that is being served if it was stored more than
+    STALE_CATALOG_AGE seconds ago, in the background service when it runs, otherwise on a thread of this run
+    :param updated: when the catalog data behind the listing was stored
+    :param kind: listing for Crawler.refresh_listing, series, movie_listings or episodes
+    :param entity_id: channel or season the listing belongs to
+    """
+    if not (stale_listings and updated):
+        return
+    age = time.time() - updated
+    listing_ages.append(age)
+    if age <= STALE_CATALOG_AGE:
+        return
+    refresh_listing = getattr(session, 'refresh_listing', None)
+    if refresh_listing and refresh_listing(kind, entity_id):
+        return
+    if catalog.claim('refresh/{}/{}'.format(kind, entity_id), REFRESH_CLAIM):
+        crawler = Crawler(session, catalog, should_stop=xbmc.Monitor().abortRequested)
+        threading.Thread(target=crawler.refresh_listing, args=(kind, entity_id)).start()
+
+
+def cached_hint(directory):
+    """
+    Add a heading saying how old the cached data behind the listing is
+    """
+    if listing_ages and max(listing_ages) >= 60:
+        directory.add(None, "[cached {} minutes ago]".format(int(max(listing_ages) / 60)), transient=True)
+
+
 def get_sub(sub_url, borrowed_subs=False):
+    from sub_conv import convert_subs
     filename = os.path.join(sub_temp, sub_url.split('/')[-1].split('?')[0])
-    sub_res = session.session.get(sub_url)
+    sub_res = throughput.get(session.http(), sub_url)
     if sub_res.status_code == 200:
         image_file = open(filename, 'wb')
         image_file.write(sub_res.content)
@@ -151,13 +547,77 @@ def get_sub(sub_url, borrowed_subs=False):
     return filename
 
 
+def lookup_play_head(content_id):
+    """
+    :return: the PlayHead to offer resuming from, or None
+    """
+    # a checkpoint that hasn't reached VRV yet is newer than what VRV has
+    return playhead_store.get([content_id], 0).get(content_id) or session.get_play_heads([content_id]).get(content_id)
+
+
+def playback_art(playable_obj):
+    """
+    :return: the cached art of the item, with the fanart of its parent
+    """
+    return cache_art(item_art(playable_obj))
+
+
+def playback_subtitles(playable_obj, stream):
+    """
+    Download and convert the subtitles of the stream, borrowed from the subbed season when it has none
+    :return: list of subtitle files
+    """
+    if stream.en_subtitle:
+        return [get_sub(stream.en_subtitle.url)]
+    if playable_obj.media_type == "episode" and vtt_borrow_subs:
+        my_log("Stream doesn't have subtitles! Trying to borrow from subbed season.", xbmc.LOGINFO)
+        series_id = playable_obj.series_id
+        ep_number = playable_obj.episode_number
+        seasons = session.get_cms(session.cms_url + 'seasons?series_id=' + series_id)
+        for season in seasons.items:
+            if season.subbed and not season.dubbed:
+                sub_eps = session.get_cms(session.cms_url + 'episodes?season_id=' + season.id)
+                sub_ep = session.get_cms(session.cms_url + 'episodes/' + sub_eps.items[int(ep_number)-1].id)
+                if sub_ep.streams:
+                    sub_str = session.get_cms(sub_ep.streams)
+                    if sub_str.en_subtitle:
+                        return [get_sub(sub_str.en_subtitle.url, borrowed_subs=True)]
+    return []
+
+
+def load_stream(playable_obj):
+    """
+    Fetch the streams of the item and pick the url to play, starting the subtitle download on the way
+    :return: tuple of the url and the Task of playback_subtitles
+    """
+    stream = session.get_cms(playable_obj.streams)
+    sub_task = session.pool.submit(playback_subtitles, playable_obj, stream)
+    return prepstream(stream.hls), sub_task
+
+
+def set_art(li, art, player=None):
+    """
+    :param player: the player li is already playing in, it is told about the new art
+    """
+    li.setArt(art)
+    if player and hasattr(player, 'updateInfoTag'):
+        player.updateInfoTag(li)
+
+
+def set_subtitles(player, files):
+    for filename in files:
+        player.setSubtitles(filename)
+
+
 def setup_player(playable_obj):
     timeout = 30
-    failure = False
     if hasattr(playable_obj, 'streams') and hasattr(playable_obj, 'get_play_head'):
         dialog = Dialog()
-        stream = session.get_cms(playable_obj.streams)
-        playhead = playable_obj.get_play_head(session)
+        # only the stream url is needed to start playing, it is picked while the user answers the resume
+        # question, subtitles and art follow whenever they are ready
+        stream_task = session.pool.submit(load_stream, playable_obj)
+        art_task = session.pool.submit(playback_art, playable_obj)
+        playhead = lookup_play_head(playable_obj.id)
 
         if playhead and not playhead.completion_status:
             timestamp = format_time(playhead.position)
@@ -175,32 +635,6 @@ def setup_player(playable_obj):
         li = ListItem(playable_obj.title)
         if playable_obj.media_type == "episode":
             li.setLabel2(str(playable_obj.episode_number))
-            if not stream.en_subtitle and vtt_borrow_subs:
-                my_log("Stream doesn't have subtitles! Trying to borrow from subbed season.", xbmc.LOGINFO)
-                series_id = playable_obj.series_id
-                ep_number = playable_obj.episode_number
-                seasons = session.get_cms(cms_url + 'seasons?series_id=' + series_id)
-                for season in seasons.items:
-                    if season.subbed and not season.dubbed:
-                        sub_eps = session.get_cms(cms_url + 'episodes?season_id=' + season.id)
-                        sub_ep = session.get_cms(cms_url + 'episodes/' + sub_eps.items[int(ep_number)-1].id)
-                        if sub_ep.streams:
-                            sub_str = session.get_cms(sub_ep.streams)
-                            if sub_str.en_subtitle:
-                                li.setSubtitles([get_sub(sub_str.en_subtitle.url,borrowed_subs=True)])
-
-
-
-        if playable_obj.images:
-            art_cache = cache_art(playable_obj.images.kodi_setart_dict())
-            li.setArt(art_cache)
-        try:
-            parent_ac = get_parent_art(playable_obj)
-        except:
-            parent_ac = None
-        
-        if parent_ac:
-            li.setArt({'fanart': parent_ac.get('fanart')})
         li.setInfo('video', playable_obj.kodi_info())
         if adaptive:  # set properties required for inputstream adaptive
             li.setProperty('inputstreamaddon', 'inputstream.adaptive')
@@ -208,48 +642,51 @@ def setup_player(playable_obj):
             li.setMimeType('application/dash+xml')
             li.setContentLookup(False)
 
-        player = xbmc.Player()
+        loaded = stream_task.result()
+        if isinstance(loaded, Exception):
+            my_log("Couldn't load the stream: {!r}".format(loaded), xbmc.LOGERROR)
+            dialog.notification("VRV", "Failed to load stream.", icon=xbmcgui.NOTIFICATION_ERROR, time=5000)
+            return
+        stream_url, sub_task = loaded
+
+        sync = PlayheadSync(playhead_store, session)
+        sync.start()
+        player = VRVPlayer(resume_at=last_pos,
+                           checkpoint=lambda position: playhead_store.record(playable_obj.id, position))
 
         my_log("Setting up player object. PlayHead position is %s." % (last_pos), xbmc.LOGDEBUG)
-        if stream.en_subtitle:
-            li.setSubtitles([get_sub(stream.en_subtitle.url)])
+        # what is ready goes into the ListItem, the rest is handed to the player once playback started
+        if art_task.done():
+            if isinstance(art_task.result(), dict):
+                set_art(li, art_task.result())
+        else:
+            player.attach(art_task, lambda art: set_art(li, art, player))
+        if sub_task.done():
+            if isinstance(sub_task.result(), list):
+                li.setSubtitles(sub_task.result())
+        else:
+            player.attach(sub_task, lambda files: set_subtitles(player, files))
 
-        player.play(prepstream(stream.hls), li, False, last_pos)
-        tried_seek = False
+        player.play(stream_url, li, False, last_pos)
+        session.pool.submit(prefetch_next_stream, playable_obj)
         my_log("Told Kodi to play stream URL. Now we wait...", xbmc.LOGDEBUG)
-        loops = 0
-        # wait for kodi to start playing
-        while not player.isPlaying():
-            xbmc.sleep(1000)
-            loops += 1
-            if loops > timeout:
-                dialog.notification("VRV", "Failed to play stream. Check config?", icon=xbmcgui.NOTIFICATION_ERROR,
-                                    time=5000)
-                failure = True
-                break
-        current_pos = 0
-        # main polling loop. it's probably not the most elegant/efficient way, but it works
-        while player.isPlaying():
-            """ if user chose to resume, tell the player to seek
-                it's supposed to, per the docs, to do this in the player.play call, but due to a bug or
-                my ignorance, it doesn't. so we force its hand here
-                TODO: this seems to break sync with subtitles.
-            """
-            if not tried_seek and last_pos > 0:
-                my_log("Trying to get Kodi to seek to %s." % (last_pos), xbmc.LOGDEBUG)
-                player.seekTime(float(last_pos))
-                xbmc.sleep(1000)  # wait for kodi to response
-                current_pos = int(player.getTime())
-                tried_seek = (current_pos >= last_pos)
-
-            current_pos = int(player.getTime())
-            # just get the current playback position and sleep
-            xbmc.sleep(2000)
-        # stopped playback (hopefully), so update our position on the server
-        if not failure:
-            playable_obj.post_play_head(session, current_pos)
+        if player.wait(xbmc.Monitor(), timeout):
+            # stopped playback, the sync thread sends the position to VRV once more and exits
+            playhead_store.record(playable_obj.id, player.position, completed=player.ended)
+            sync.stop()
+            if player.failed:
+                my_log("Playback failed at {}s.".format(player.position), xbmc.LOGERROR)
             my_log("Done playing.", xbmc.LOGDEBUG)
+            if probe_bandwidth and not adaptive:
+                # nothing else is downloading now, time a segment of what was played for the next variant choice
+                try:
+                    probe_segment(stream_url, session.http(), throughput)
+                except Exception as e:
+                    my_log("Measuring throughput failed: {!r}".format(e), xbmc.LOGDEBUG)
         else:
+            sync.stop()
+            dialog.notification("VRV", "Failed to play stream. Check config?", icon=xbmcgui.NOTIFICATION_ERROR,
+                                time=5000)
             my_log("Error(s) encountered while trying to play stream.", xbmc.LOGERROR)
             if adaptive:
                 my_log("InputStream Adaptive is possibly not installed or configured?", xbmc.LOGERROR)
@@ -259,111 +696,134 @@ def prepstream(stream_url):
     if adaptive:
         return stream_url
     else:
-        pl_parse = m3u8.load(stream_url)
-        current_max_res = 0
-        req_res_pl = None
-        max_res_pl = None
-        for playlist in pl_parse.playlists:
-            res = playlist.stream_info.resolution
-            my_log("Stream is available in {}x{}.".format(res[0], res[1]), xbmc.LOGNOTICE)
-            if 0 < set_res == res[1]:
-                current_max_res = res[1]
-                req_res_pl = playlist
-            if res[1] > current_max_res:
-                current_max_res = res[1]
-                max_res_pl = playlist
-
-        if not req_res_pl:  # if the resolution requested isn't available, just use the highest available
-            req_res_pl = max_res_pl
-            my_log("Couldn't find requested resolution, using {}p".format(current_max_res), xbmc.LOGDEBUG)
-
-        return req_res_pl.uri
-
-
-def handle_panel(panel, li, set_menu=True):
+        variants = variant_cache.variants(stream_url, session.http(), throughput)
+        if not variants:
+            my_log("Couldn't read the stream's variants, playing the master playlist", xbmc.LOGWARNING)
+            return stream_url
+        # the resolution setting is the cap, below it the measured throughput decides
+        estimate = throughput.estimate()
+        variant = select_variant(variants, estimate, set_res)
+        my_log("Playing {} at {} with the cap at {}p".format(
+            variant, "{:.0f}kbps".format(estimate / 1000) if estimate else "unknown throughput", set_res),
+            xbmc.LOGDEBUG)
+        return variant.uri
+
+
+def prefetch_next_stream(playable_obj):
+    """
+    Read the master playlist of the next episode ahead of time, so starting it skips that round trip
+    """
+    next_id = getattr(playable_obj, 'next_episode_id', None)
+    if adaptive or not next_id:
+        return
+    next_episode = session.get_cms(session.cms_url + 'episodes/' + next_id)
+    if getattr(next_episode, 'streams', None):
+        # not timed, playback of the current episode shares the link
+        variant_cache.variants(session.get_cms(next_episode.streams).hls, session.http())
+
+
+def fetch_panel_resources(panels):
+    """
+    Fetch the episodes and seasons behind panels in parallel, along with their parent series
+    :param panels: Panel objects about to go through handle_panel
+    :return: dictionary of panel id to the fetched resource
+    """
+    kinds = {'episode': 'episodes/', 'season': 'seasons/'}
+    wanted = [p for p in panels if p.ptype in kinds]
+    results = session.get_cms_many([session.cms_url + kinds[p.ptype] + p.id for p in wanted])
+    resources = dict((p.id, res) for p, res in zip(wanted, results) if isinstance(res, VRVResponse))
+    session.memo.prefetch('series', [getattr(res, 'series_id', None) for res in resources.values()])
+    return resources
+
+
+def handle_panel(directory, panel, label, set_menu=True, resources=None, **fields):
+    """
+    :param directory: Directory the panel is added to
+    :param fields: passed on to Directory.add
+    """
+    resources = resources or {}
     if panel.images:
-        art_cache = cache_art(panel.images.kodi_setart_dict())
-        li.setArt(art_cache)
+        fields['art'] = panel.images.kodi_setart_dict(art_targets)
 
     if panel.ptype == "series":
         # item_res = session.get_cms(cms_url + 'series/' + panel.id)
-        li.setInfo('video', panel.kodi_info())
-        li.setProperty('TotalSeasons', str(panel.season_count))
-        li.setProperty('TotalEpisodes', str(panel.episode_count))
+        fields['info'] = panel.kodi_info()
+        fields['properties'] = {'TotalSeasons': str(panel.season_count),
+                                'TotalEpisodes': str(panel.episode_count)}
         add_url = plugin.url_for(add_to_watchlist, rid=panel.id)
         my_log("add_url is {}".format(add_url), xbmc.LOGDEBUG)
         context_items = [('Add to watchlist', "XBMC.RunPlugin({})".format(add_url))]
         if set_menu:
-            li.addContextMenuItems(context_items, False)
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(series, panel.id), li, True)
+            fields['menu'] = context_items
+        directory.add(plugin.url_for(series, panel.id), label, **fields)
     elif panel.ptype == "movie_listing":
         # item_res = session.get_cms(cms_url + 'movie_listings/' + panel.id)
-        li.setInfo('video', panel.kodi_info())
+        fields['info'] = panel.kodi_info()
         add_url = plugin.url_for(add_to_watchlist, rid=panel.id)
         my_log("add_url is {}".format(add_url), xbmc.LOGDEBUG)
         context_items = [('Add to watchlist', "XBMC.RunPlugin({})".format(add_url))]
         if set_menu:
-            li.addContextMenuItems(context_items)
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(movie_listing, panel.id), li, True)
+            fields['menu'] = context_items
+        directory.add(plugin.url_for(movie_listing, panel.id), label, **fields)
     elif panel.ptype == "movie":
         # item_res = session.get_cms(cms_url + 'movies/' + panel.id)
-        li.setInfo('video', panel.kodi_info())
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(movie, panel.id), li, True)
+        fields['info'] = panel.kodi_info()
+        directory.add(plugin.url_for(movie, panel.id), label, **fields)
     elif panel.ptype == "episode":
-        episode_res = session.get_cms(cms_url + 'episodes/' + panel.id)
-        parent_ac = get_parent_art(episode_res)
-        li.setInfo('video', episode_res.kodi_info())
-        li.setArt({'fanart': parent_ac.get('fanart')})
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(episode, panel.id), li, True)
+        episode_res = resources.get(panel.id) or session.get_cms(session.cms_url + 'episodes/' + panel.id)
+        parent_fanart = get_parent_art(episode_res).get('fanart')
+        fields['info'] = episode_res.kodi_info()
+        if parent_fanart:
+            fields['art'] = dict(fields.get('art') or {}, fanart=parent_fanart)
+        directory.add(plugin.url_for(episode, panel.id), label, **fields)
     elif panel.ptype == "season":
-        season_res = session.get_cms(cms_url + 'seasons/' + panel.id)
-        li.setInfo('video', get_parent_info(season_res))
-        parent_ac = get_parent_art(season_res)
-        li.setArt(parent_ac)
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(season, panel.id), li, True)
+        season_res = resources.get(panel.id) or session.get_cms(session.cms_url + 'seasons/' + panel.id)
+        fields['info'] = get_parent_info(season_res)
+        fields['art'] = dict(fields.get('art') or {}, **get_parent_art(season_res))
+        directory.add(plugin.url_for(season, panel.id), label, **fields)
     elif panel.ptype == "curated_feed":
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(feed, panel.id), li, True)
+        directory.add(plugin.url_for(feed, panel.id), label, **fields)
 
 
 @plugin.route('/')
 def index():
     item_tuple = (("Watchlist", "/watchlist"), ("Channels", "/channels"), ("Search", "/search"),
                   ("Feeds/Recommended", "/feeds"))
+    directory = open_directory(index)
     if session.logged_in:
         for title, route in item_tuple:
-            li = ListItem(title)
-            xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for_path(route), li, True)
-    xbmcplugin.endOfDirectory(plugin.handle)
+            directory.add(plugin.url_for_path(route), title)
+    directory.finish()
 
 
 @plugin.route('/feeds')
 def feeds():
+    directory = open_directory(feeds)
+    if directory.replay():
+        return
     cms_links = session.cms_index.links
     if 'primary_feed' in cms_links:
-        pri_feed = session.get_cms(session.cms_index.links['primary_feed'])
+        pri_feed = listing_get(session.cms_index.links['primary_feed'])
     else:
         pri_feed = None
     if 'home_feeds' in cms_links:
-        home_feeds = session.get_cms(session.cms_index.links['home_feeds'])
+        home_feeds = listing_get(session.cms_index.links['home_feeds'])
     else:
         home_feeds = None
+    cached_hint(directory)
     if pri_feed:
-        li = ListItem("Recommended:")
-        xbmcplugin.addDirectoryItem(plugin.handle, None, li, True)
+        directory.add(None, "Recommended:")
+        resources = fetch_panel_resources(pri_feed.items)
         for rec_item in pri_feed.items:
-            li = ListItem(rec_item.title)
-            handle_panel(rec_item, li)
+            handle_panel(directory, rec_item, rec_item.title, resources=resources)
     if home_feeds:
-        li = ListItem("Other Feeds:")
-        xbmcplugin.addDirectoryItem(plugin.handle, None, li, True)
+        directory.add(None, "Other Feeds:")
         for feed_item in home_feeds.items:
             if feed_item.rclass == 'curated_feed':
-                li = ListItem(feed_item.title)
-                xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(feed, feed_item.id), li, True)
+                directory.add(plugin.url_for(feed, feed_item.id), feed_item.title)
     if not pri_feed and not home_feeds:
-        li = ListItem("Sorry, couldn't load feeds.")
-        xbmcplugin.addDirectoryItem(plugin.handle, None, li, True)
-    xbmcplugin.endOfDirectory(plugin.handle)
+        directory.add(None, "Sorry, couldn't load feeds.", transient=True)
+    directory.finish()
 
 
 @plugin.route('/search')
@@ -372,12 +832,17 @@ def search():
     query = plugin.args.get('query', [''])[0]
     start = plugin.args.get('start', [0])[0]
     result_size = plugin.args.get('n', [0])[0]
-    search_url = session.cms_index.links['search_results']
+    online = plugin.args.get('online', [None])[0]
     if not query:
         keyboard = xbmc.Keyboard('', 'Enter search query:', False)
         keyboard.doModal()
         if keyboard.isConfirmed():
             query = keyboard.getText()
+    if query and catalog and not online:
+        hits = catalog.search(query if isinstance(query, unicode) else query.decode('utf-8'))
+        if hits:
+            local_search(query, hits)
+            return
     if result_size == 0:
         keyboard = xbmc.Keyboard(str(default_size), 'Number of results per page:', False)
         keyboard.doModal()
@@ -387,19 +852,43 @@ def search():
             except:
                 result_size = default_size
     if query:
+        # only read here, the index needs a login that offline catalog hits can do without
+        search_url = session.cms_index.links['search_results']
         search_params = {'q': query, 'n': result_size, 'start': '.' + str(start)}
-        search_results = session.get_cms(search_url + '?' + urlencode(search_params))
+        search_results = session.get_cms(search_url + '?' + urlencode(search_params), match_type=False)
+        if catalog and type(search_results) == dict:
+            catalog.index_documents(search_results.get('items') or [])
+        search_results = vrv_json_hook(search_results)
+        resources = fetch_panel_resources(search_results.items)
+        directory = open_directory(search)
         for res_panel in search_results.items:
-            li = ListItem(res_panel.title + ' ' + res_panel.lang + ' (' + capwords(res_panel.channel_id) + ') ('
-                          + res_panel.ptype + ')')
-            handle_panel(res_panel, li)
+            handle_panel(directory, res_panel, res_panel.title + ' ' + res_panel.lang + ' (' +
+                         capwords(res_panel.channel_id) + ') (' + res_panel.ptype + ')', resources=resources)
 
         if search_results.links.get('continuation'):
-            li = ListItem('More...')
             new_start = int(start) + int(result_size)
-            xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(search, query=quote_plus(query), start=new_start,
-                                                                      n=result_size), li, True)
-        xbmcplugin.endOfDirectory(plugin.handle)
+            directory.add(plugin.url_for(search, query=quote_plus(query), start=new_start, n=result_size), 'More...')
+        directory.finish()
+
+
+def local_search(query, hits):
+    """
+    Render hits from the offline catalog, with a way to run the query against VRV instead
+    """
+    panels = [hit for hit in hits if hit.rclass == 'panel']
+    resources = fetch_panel_resources(panels)
+    directory = open_directory(search)
+    for hit in hits:
+        if hit.rclass == 'panel':
+            handle_panel(directory, hit, hit.title + ' ' + hit.lang + ' (' + capwords(hit.channel_id or '') + ') ('
+                         + hit.ptype + ')', resources=resources)
+        else:
+            target = episode if hit.rclass == 'episode' else movie
+            directory.add(plugin.url_for(target, hit.id), u'{} ({})'.format(hit.title, hit.rclass), folder=False,
+                          art=hit.images.kodi_setart_dict(art_targets) if hit.images else None,
+                          info=hit.kodi_info())
+    directory.add(plugin.url_for(search, query=query, online=1), 'Search online...')
+    directory.finish()
 
 
 @plugin.route('/add_to_watchlist')
@@ -424,10 +913,19 @@ def delete_from_watchlist():
 def watchlist():
     page = int(plugin.args.get('page', [1])[0])
     length = plugin.args.get('page_length', [20])[0]
-    wl = session.get_watchlist(page_length=length, page=page)
+    wl = listing_get(session.watchlist_path(page_length=length, page=page), session.get_core)
+    directory = open_directory(watchlist)
+    if not isinstance(wl, VRVResponse):
+        directory.add(None, "Sorry, couldn't load the watchlist.", transient=True)
+        directory.finish()
+        return
+    cached_hint(directory)
+    resources = fetch_panel_resources([i.panel for i in wl.items])
     for i in wl.items:
         pan = i.panel
-        li = ListItem('{} {} ({})'.format(pan.title, pan.lang, capwords(pan.channel_id)))
+        fields = {}
+        if pan.ptype in ('episode', 'movie'):
+            fields['playhead'] = pan.id
 
         delete_link = i.actions.get('watchlist/delete')
         my_log("Available actions for {} are {}.".format(i.panel.id, i.actions), xbmc.LOGDEBUG)
@@ -437,135 +935,191 @@ def watchlist():
             remove_url = plugin.url_for(delete_from_watchlist, wlid=wl_id)
             my_log("remove_url is {}".format(remove_url), xbmc.LOGDEBUG)
             context_items = [(('Remove from watchlist', "XBMC.RunPlugin({})".format(remove_url)))]
-            li.addContextMenuItems(context_items)
-        handle_panel(i.panel, li, set_menu=False)
+            fields['menu'] = context_items
+        handle_panel(directory, i.panel, u'{} {} ({})'.format(pan.title, pan.lang, capwords(pan.channel_id)),
+                     set_menu=False, resources=resources, **fields)
     if wl.links.get('next'):
-        li = ListItem('More...')
         page += 1
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(watchlist, page=page, start=length), li, True)
+        directory.add(plugin.url_for(watchlist, page=page, start=length), 'More...')
+
+    directory.finish()
+
+
+def run_crawler(mode):
+    """
+    :param mode: crawl for a full walk of the catalog, sync for changes only
+    """
+    if not catalog:
+        Dialog().notification("VRV", "Enable the offline catalog under settings first.", time=1000, sound=False)
+        return
+    progress = xbmcgui.DialogProgressBG()
+    progress.create("VRV", "Updating offline catalog")
+    monitor = xbmc.Monitor()
+    crawler = Crawler(session, catalog, progress=lambda message, percent: progress.update(percent, message=message),
+                      should_stop=monitor.abortRequested)
+    started = time.time()
+    try:
+        finished = getattr(crawler, mode)()
+    finally:
+        progress.close()
+    my_log("Catalog {} {} after {:.0f}s, {} changes".format(mode, 'finished' if finished else 'stopped',
+                                                           time.time() - started, len(catalog.changes(started))),
+           xbmc.LOGNOTICE)
+
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+@plugin.route('/catalog/crawl')
+def crawl_catalog():
+    run_crawler('crawl')
+
+
+@plugin.route('/catalog/sync')
+def sync_catalog():
+    run_crawler('sync')
 
 
 @plugin.route('/channels')
 def channels():
-    channels_data = session.get_cms(session.links['channels'])
-    for chan in channels_data.items:
-        li = ListItem(capwords(chan.id))
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(channel, chan.cms_id), li, True)
-    xbmcplugin.endOfDirectory(plugin.handle)
+    directory = open_directory(channels)
+    if directory.replay():
+        return
+    channel_items = catalog and catalog.channels()
+    if not channel_items:
+        channel_items = listing_get(session.links['channels']).items
+        cached_hint(directory)
+    for chan in channel_items:
+        directory.add(plugin.url_for(channel, chan.cms_id), capwords(chan.id))
+    directory.finish()
 
 
 @plugin.route('/channel/<cid>')
 def channel(cid):
-    channel_data = session.get_cms(cms_url + "channels/" + cid)
+    directory = open_directory(channel, cid)
+    if directory.replay():
+        return
+    channel_data = session.get_cms(session.cms_url + "channels/" + cid)
     if channel_data.links:
         if channel_data.links.get('channel/series'):
-            li = ListItem('Series')
-            xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(chseries, id=cid), li, True)
+            directory.add(plugin.url_for(chseries, id=cid), 'Series')
         if channel_data.links.get('channel/movie_listings'):
-            li = ListItem('Movies')
-            xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(chmovies, id=cid), li, True)
-    xbmcplugin.endOfDirectory(plugin.handle)
+            directory.add(plugin.url_for(chmovies, id=cid), 'Movies')
+    directory.finish()
 
 
 @plugin.route('/chseries')
 def chseries():
+    directory = open_directory(chseries)
+    if directory.replay():
+        return
     channel_id = plugin.args.get('id', [None])[0]
-    if channel_id:
-        cont = int(plugin.args.get('cont', [0])[0])
-        limit = plugin.args.get('limit', [20])[0]
-        series_url = "{}series?channel_id={}&cont={}&limit={}&mode=channel".format(cms_url, channel_id, cont, limit)
+    if channel_id and catalog and catalog.channel_refreshed(channel_id):
+        revalidate_catalog(catalog.channel_refreshed(channel_id), 'series', channel_id)
+        cached_hint(directory)
+        for i in catalog.channel_series(channel_id):
+            handle_panel(directory, i, i.title)
+    elif channel_id:
+        series_url = plugin.args.get('path', [None])[0]
+        if not series_url:
+            cont = int(plugin.args.get('cont', [0])[0])
+            limit = plugin.args.get('limit', [20])[0]
+            series_url = "{}series?channel_id={}&cont={}&limit={}&mode=channel".format(session.cms_url, channel_id,
+                                                                                      cont, limit)
         my_log("Series url is " + series_url, xbmc.LOGDEBUG)
-        show_data = session.get_cms(series_url)
-        for i in show_data.items:
-            li = ListItem(i.title)
-            handle_panel(i, li)
-        if show_data.links.get('continuation'):
-            next_item = ListItem("More...")
-            xbmcplugin.addDirectoryItem(plugin.handle,
-                                        plugin.url_for(chseries, id=channel_id, cont=int(cont) + int(limit),
-                                                       limit=limit), next_item, True)
-            xbmcplugin.endOfDirectory(plugin.handle)
+        # the page after this one loads into the response cache while this one renders
+        show_data = session.paginate(series_url, fetch=listing_get, max_pages=1)
+        show_items = list(show_data)
+        cached_hint(directory)
+        for i in show_items:
+            handle_panel(directory, i, i.title)
+        if show_data.next_path:
+            directory.add(plugin.url_for(chseries, id=channel_id, path=show_data.next_path), "More...")
+    directory.finish()
 
 
 @plugin.route('/chmovies')
 def chmovies():
+    directory = open_directory(chmovies)
+    if directory.replay():
+        return
     channel_id = plugin.args.get('id', [None])[0]
-    if channel_id:
-        cont = int(plugin.args.get('cont', [0])[0])
-        limit = plugin.args.get('limit', [20])[0]
-        movies_url = "{}movie_listings?channel_id={}&cont={}&limit={}&mode=channel".format(cms_url, channel_id, cont,
-                                                                                           limit)
+    if channel_id and catalog and catalog.channel_refreshed(channel_id):
+        revalidate_catalog(catalog.channel_refreshed(channel_id), 'movie_listings', channel_id)
+        cached_hint(directory)
+        for i in catalog.channel_movie_listings(channel_id):
+            handle_panel(directory, i, i.title)
+    elif channel_id:
+        movies_url = plugin.args.get('path', [None])[0]
+        if not movies_url:
+            cont = int(plugin.args.get('cont', [0])[0])
+            limit = plugin.args.get('limit', [20])[0]
+            movies_url = "{}movie_listings?channel_id={}&cont={}&limit={}&mode=channel".format(session.cms_url,
+                                                                                               channel_id, cont,
+                                                                                               limit)
         my_log("Movies url is " + movies_url, xbmc.LOGDEBUG)
-        movie_data = session.get_cms(movies_url)
-        for i in movie_data.items:
-            li = ListItem(i.title)
-            handle_panel(i, li)
-        if movie_data.links.get('continuation'):
-            next_item = ListItem("More")
-            xbmcplugin.addDirectoryItem(plugin.handle,
-                                        plugin.url_for(chmovies, id=channel_id, cont=int(cont) + int(limit),
-                                                       limit=limit), next_item, True)
-            xbmcplugin.endOfDirectory(plugin.handle)
+        movie_data = session.paginate(movies_url, fetch=listing_get, max_pages=1)
+        movie_items = list(movie_data)
+        cached_hint(directory)
+        for i in movie_items:
+            handle_panel(directory, i, i.title)
+        if movie_data.next_path:
+            directory.add(plugin.url_for(chmovies, id=channel_id, path=movie_data.next_path), "More")
+    directory.finish()
 
 
 @plugin.route('/notavail')
 def notavail():
-    li = ListItem("Not implemented yet.")
-    xbmcplugin.addDirectoryItem(plugin.handle, '/', li, False)
-    xbmcplugin.endOfDirectory(plugin.handle)
+    directory = open_directory(notavail)
+    directory.add('/', "Not implemented yet.", folder=False)
+    directory.finish()
 
 
 @plugin.route('/movie_listing/<nid>')
 def movie_listing(nid):
     my_log('got to movie_listing ' + str(nid), xbmc.LOGDEBUG)
-    movies_list = session.get_cms(cms_url + 'movie_listings/' + nid)
-    movies = session.get_cms(movies_list.movies_path)
-    for i in movies.items:
-        stream = session.get_cms(i.streams)
-        li = ListItem(i.title)
-        if i.images:
-            art_cache = cache_art(i.images.kodi_setart_dict())
-            li.setArt(art_cache)
-        parent_ac = get_parent_art(i)
-        
-        li.setInfo('video', i.kodi_info())
-        li.setArt({'fanart': parent_ac.get('fanart')})
-        if stream.en_subtitle:
-            li.setSubtitles([stream.en_subtitle.url])
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(movie, i.id), li)
-    xbmcplugin.endOfDirectory(plugin.handle)
+    movie_items = catalog and catalog.listing_movies(nid)
+    if not movie_items:
+        movies_list = session.memo.movie_listing(nid)
+        movie_items = session.get_cms(movies_list.movies_path).items
+    streams = session.get_cms_many([i.streams for i in movie_items])
+    directory = open_directory(movie_listing, nid)
+    for i, stream in zip(movie_items, streams):
+        subtitles = None
+        if getattr(stream, 'en_subtitle', None):
+            subtitles = [stream.en_subtitle.url]
+        directory.add(plugin.url_for(movie, i.id), i.title, folder=False, playhead=i.id, art=item_art(i),
+                      info=i.kodi_info(), subtitles=subtitles)
+    directory.finish()
 
 
 @plugin.route('/movie/<mid>')
 def movie(mid):
-    movie = session.get_cms(cms_url + 'movies/' + mid)
+    movie = session.get_cms(session.cms_url + 'movies/' + mid)
     setup_player(movie)
 
 
 @plugin.route('/series/<nid>')
 def series(nid):
     my_log('got to series ' + str(nid), xbmc.LOGDEBUG)
-    seasons = session.get_cms(cms_url + 'seasons?series_id=' + nid)
-    series = session.get_cms(cms_url + 'series/' + nid)
+    season_items = catalog and catalog.series_seasons(nid)
+    if not season_items:
+        season_items = session.get_cms(session.cms_url + 'seasons?series_id=' + nid).items
+    series = session.memo.series(nid)
     if series:
         series_info = series.kodi_info()
     else:
         series_info = dict()
 
-    if len(seasons.items) == 1:
+    if len(season_items) == 1:
         my_log('series only has one season, skipping to episodes section', xbmc.LOGDEBUG)
-        season(seasons.items[0].id)
+        season(season_items[0].id)
     else:
         my_log('series has more than one, displaying context menu', xbmc.LOGDEBUG)
         dummy_dialog = Dialog()
         season_names = []
-        for item in seasons.items:
+        for item in season_items:
             season_names.append(item.title)
         choice = dummy_dialog.contextmenu(season_names)
         if choice > -1:
-            season(seasons.items[choice].id)
+            season(season_items[choice].id)
     # for i in seasons.items:
     #     li = ListItem(i.title)
     #     art_cache = get_parent_art(i)
@@ -579,52 +1133,50 @@ def series(nid):
 
 @plugin.route('/feed/<fid>')
 def feed(fid):
-    feed = session.get_cms(cms_url + 'curated_feeds/' + fid + '?version=1.1')
-
-    if feed.status_code == 200:
-        for item in feed.items:
-            li = ListItem(item.title)
+    directory = open_directory(feed, fid)
+    if directory.replay():
+        return
+    feed_res = session.get_cms(session.cms_url + 'curated_feeds/' + fid + '?version=1.1')
+
+    if feed_res.status_code == 200:
+        resources = fetch_panel_resources([item for item in feed_res.items if item.rclass == 'panel'])
+        for item in feed_res.items:
             if item.rclass == 'panel':
-                handle_panel(item, li)
+                handle_panel(directory, item, item.title, resources=resources)
             elif item.rclass == 'curated_feed':
-                xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(feed, item.id), True)
-        xbmcplugin.endOfDirectory(plugin.handle)
+                directory.add(plugin.url_for(feed, item.id), item.title)
+        directory.finish()
 
 
 @plugin.route('/season/<nid>')
 def season(nid):
     my_log("Adaptive Mode: " + str(adaptive), xbmc.LOGNOTICE)
-    eps = session.get_cms(cms_url + 'episodes?season_id=' + nid)
-    for i in eps.items:
-        iph = i.get_play_head(session)
+    directory = open_directory(season, nid)
+    if directory.replay():
+        return
+    episode_items = catalog and catalog.season_episodes(nid)
+    if episode_items:
+        revalidate_catalog(catalog.season_updated(nid), 'episodes', nid)
+    else:
+        episode_items = listing_get(session.cms_url + 'episodes?season_id=' + nid).items
+    cached_hint(directory)
+    for i in episode_items:
         title = i.title
-        if iph:
-            if iph.completion_status:
-                title = u"{} [Status: Completed]".format(i.title)
-            else:
-                title = u"{} [Status: In Progress: {}]".format(i.title, format_time(iph.position))
         if not i.streams:
             if i.available_date:
                 a_date = time.strptime(i.available_date,'%Y-%m-%dT%H:%M:%SZ')
                 title = "{} [TBA on {}]".format(title, time.strftime("%m/%d/%y %I:%M:%S %P", a_date))
             else:
                 title = "{} [NOT AVAILABLE]".format(title)
-        li = ListItem(title)
-        li.setLabel2(str(i.episode_number))
-        if i.images:
-            art_cache = cache_art(i.images.kodi_setart_dict())
-            li.setArt(art_cache)
-        parent_ac = get_parent_art(i)
-        li.setArt({'fanart': parent_ac.get('fanart')})
-        li.setInfo('video', i.kodi_info())
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(episode, i.id), li)
-    xbmcplugin.endOfDirectory(plugin.handle)
+        directory.add(plugin.url_for(episode, i.id), title, folder=False, label2=str(i.episode_number),
+                      playhead=i.id if i.streams else None, art=item_art(i), info=i.kodi_info())
+    directory.finish()
 
 
 @plugin.route('/episode/<eid>')
 def episode(eid):
 
-    episode = session.get_cms(cms_url + 'episodes/' + eid)
+    episode = session.get_cms(session.cms_url + 'episodes/' + eid)
     if episode.available_date:
         try:
             #title = "{} [TBA on {}]".format(title, time.strftime("%m/%d/%y %I:%M:%S %P", a_date))
@@ -646,3 +1198,13 @@ def episode(eid):
 
 if __name__ == '__main__':
     plugin.run()
+    log_startup()
+    if not use_service and plugin.path.strip('/').split('/')[0] not in ('episode', 'movie'):
+        # the service sends these when it runs, playback starts a sync of its own
+        flush_play_heads()
+    if throughput.built:
+        throughput.persist()
+    if session.built:
+        # routes that never needed the session don't log in just for its statistics
+        my_log("{saved} of {calls} CMS requests were answered by an identical request".format(
+            **session.flights.stats()), xbmc.LOGDEBUG)
@@ -0,0 +1,253 @@
+"""
+artcache.py
+Size capped on-disk cache for posters, banners and thumbnails
+"""
+import os
+import sqlite3
+import threading
+import time
+from StringIO import StringIO
+
+from workers import WorkerPool
+
+# PIL is slow to import, load_pil brings it in once resizing is wanted
+Image = None
+
+# only shrink images that are at least this much wider than wanted
+RESIZE_SLACK = 1.25
+
+
+def load_pil():
+    """
+    :return: PIL's Image module or None if PIL isn't installed
+    """
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image as pil_image
+        except ImportError:
+            return None
+        Image = pil_image
+    return Image
+
+
+class ArtCache(object):
+    """
+    Downloads artwork in parallel into a directory and evicts the least recently used files
+    once the directory grows past max_bytes
+    With resize set and PIL available, images are stored shrunk to the width their art type needs
+    """
+
+    def __init__(self, directory, http, max_bytes=100 * 1024 * 1024, workers=4, resize=False):
+        """
+        :param directory: where the images are kept, the index database lives next to them
+        :param http: callable returning a requests-like session for the calling thread
+        :param max_bytes: size cap for all cached images
+        :param workers: most downloads running at once
+        :param resize: store downscaled copies, ignored when PIL can't be imported
+        """
+        self.directory = directory
+        self.http = http
+        self.max_bytes = max_bytes
+        self.resize = resize and load_pil() is not None
+        self.pool = WorkerPool(workers)
+        self.index_path = os.path.join(directory, 'art_index.db')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_flight = dict()
+        self._accessed = dict()
+        if not os.path.exists(self.index_path):
+            self.sweep()
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS art ('
+                         'url TEXT PRIMARY KEY, filename TEXT, size INTEGER, last_access REAL)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def filename(url, width=None):
+        """
+        :param width: width of a downscaled copy
+        :return: the local file name for url, shared by every art type that uses the same image
+        """
+        name = '_'.join(url.split('?')[0].split('/')[-2:])
+        if width:
+            name = 'w{}_{}'.format(width, name)
+        return name
+
+    @staticmethod
+    def key(url, width=None):
+        if width:
+            return '{}#{}'.format(url, width)
+        return url
+
+    def _width(self, atype, widths):
+        if self.resize and widths:
+            return widths.get(atype)
+        return None
+
+    def sweep(self):
+        """
+        Remove images that are not in the index, e.g. ones written before the index existed
+        """
+        known = set(row[0] for row in self._db().execute('SELECT filename FROM art'))
+        for name in os.listdir(self.directory):
+            if name.startswith('art_index.db') or name in known:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def local(self, url, width=None):
+        """
+        :return: path of the cached copy of url or None
+        """
+        path = os.path.join(self.directory, self.filename(url, width))
+        if os.path.exists(path):
+            self._accessed[self.key(url, width)] = time.time()
+            return path
+        return None
+
+    def _submit(self, url, width):
+        with self._lock:
+            task = self._in_flight.get(self.key(url, width))
+            if task is None:
+                task = self.pool.submit(self._download, url, width)
+                self._in_flight[self.key(url, width)] = task
+        return task
+
+    def fetch(self, url, width=None):
+        """
+        Download url unless it is cached, concurrent calls for the same url share one download
+        :param width: width of the downscaled copy to store, when resizing
+        :return: path of the cached copy or None if the download failed
+        """
+        path = self.local(url, width)
+        if path:
+            return path
+        result = self._submit(url, width).result()
+        with self._lock:
+            self._in_flight.pop(self.key(url, width), None)
+        if isinstance(result, Exception):
+            return None
+        return result
+
+    def _shrink(self, content, width):
+        """
+        :return: content as a JPEG no wider than width, or content itself if it is small enough already
+        """
+        try:
+            image = Image.open(StringIO(content))
+            if image.size[0] <= width * RESIZE_SLACK:
+                return content
+            image.thumbnail((width, int(image.size[1] * float(width) / image.size[0]) + 1), Image.ANTIALIAS)
+            out = StringIO()
+            image.convert('RGB').save(out, 'JPEG', quality=85)
+            return out.getvalue()
+        except Exception:
+            return content
+
+    def _download(self, url, width=None):
+        response = self.http().get(url)
+        if response.status_code != 200:
+            return None
+        content = response.content
+        if width:
+            content = self._shrink(content, width)
+        path = os.path.join(self.directory, self.filename(url, width))
+        temp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as fh:
+            fh.write(content)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        conn = self._db()
+        conn.execute('INSERT OR REPLACE INTO art VALUES (?, ?, ?, ?)',
+                     (self.key(url, width), self.filename(url, width), len(content), time.time()))
+        conn.commit()
+        return path
+
+    def prefetch(self, art, widths=None):
+        """
+        Start downloading every image that isn't cached yet without waiting for them
+        :param art: (art type, url) pairs
+        :param widths: dictionary of art type to wanted width, used when resizing
+        :return: the (url, width) pairs that are being downloaded
+        """
+        missing = []
+        for atype, url in art:
+            width = self._width(atype, widths)
+            if not url or (url, width) in missing or self.local(url, width):
+                continue
+            self._submit(url, width)
+            missing.append((url, width))
+        return missing
+
+    def cache_dict(self, art_dict, widths=None):
+        """
+        Replace the urls in a ListItem.setArt dictionary with cached files, downloading missing ones in parallel
+        Art that fails to download keeps its url
+        :param art_dict: dictionary of art type to url
+        :param widths: dictionary of art type to wanted width, used when resizing
+        :return: a new dictionary
+        """
+        return self.cache_dicts([art_dict], widths)[0]
+
+    def cache_dicts(self, art_dicts, widths=None):
+        """
+        cache_dict for the art of a whole listing, the index is written and evicted from once for all of them
+        :param art_dicts: list of dictionaries of art type to url
+        :return: list of new dictionaries, in the order of art_dicts
+        """
+        downloads = self.prefetch([pair for art_dict in art_dicts for pair in art_dict.items()], widths)
+        out = []
+        for art_dict in art_dicts:
+            out.append(dict((atype, (url and self.fetch(url, self._width(atype, widths))) or url)
+                            for atype, url in art_dict.items()))
+        if downloads:
+            self.evict()
+        else:
+            self.flush()
+        return out
+
+    def flush(self):
+        """
+        Write the access times collected since the last flush to the index
+        """
+        accessed, self._accessed = self._accessed, dict()
+        if accessed:
+            conn = self._db()
+            conn.executemany('UPDATE art SET last_access = ? WHERE url = ?',
+                             [(stamp, url) for url, stamp in accessed.items()])
+            conn.commit()
+
+    def evict(self):
+        """
+        Delete least recently used images until the cache is back under 90% of max_bytes
+        """
+        self.flush()
+        conn = self._db()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM art').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        removed = []
+        for url, name, size in conn.execute('SELECT url, filename, size FROM art ORDER BY last_access').fetchall():
+            if total <= target:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            removed.append((url,))
+            total -= size
+        conn.executemany('DELETE FROM art WHERE url = ?', removed)
+        conn.commit()
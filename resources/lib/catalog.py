@@ -0,0 +1,671 @@
+"""
+catalog.py
+Local SQLite mirror of the VRV catalog: channels, series, seasons, episodes, movie listings and movies,
+with a full text search index over them
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from array import array
+
+from vrvlib import vrv_json_hook
+from workers import WorkerPool
+
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS channels ('
+    'id TEXT PRIMARY KEY, cms_id TEXT, name TEXT, data TEXT, refreshed REAL)',
+    'CREATE TABLE IF NOT EXISTS series ('
+    'id TEXT PRIMARY KEY, channel TEXT, sequence INTEGER, title TEXT, episode_count INTEGER, '
+    'season_count INTEGER, panel TEXT, data TEXT, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS seasons ('
+    'id TEXT PRIMARY KEY, series_id TEXT, sequence INTEGER, season_number INTEGER, title TEXT, '
+    'is_complete INTEGER, data TEXT, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS episodes ('
+    'id TEXT PRIMARY KEY, season_id TEXT, series_id TEXT, sequence INTEGER, episode_number TEXT, title TEXT, '
+    'data TEXT, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS movie_listings ('
+    'id TEXT PRIMARY KEY, channel TEXT, sequence INTEGER, title TEXT, panel TEXT, data TEXT, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS movies ('
+    'id TEXT PRIMARY KEY, listing_id TEXT, sequence INTEGER, title TEXT, data TEXT, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS crawl_runs ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, finished REAL)',
+    'CREATE TABLE IF NOT EXISTS crawl_progress ('
+    'run_id INTEGER, kind TEXT, id TEXT, PRIMARY KEY (run_id, kind, id))',
+    'CREATE TABLE IF NOT EXISTS changes ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, at REAL, kind TEXT, entity_id TEXT, change TEXT, detail TEXT)',
+    'CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, until REAL)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts4(title, keywords, description)',
+    'CREATE TABLE IF NOT EXISTS search_docs ('
+    'docid INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, entity_id TEXT, data TEXT, UNIQUE (kind, entity_id))',
+    'CREATE INDEX IF NOT EXISTS series_channel ON series (channel)',
+    'CREATE INDEX IF NOT EXISTS seasons_series ON seasons (series_id)',
+    'CREATE INDEX IF NOT EXISTS episodes_season ON episodes (season_id)',
+    'CREATE INDEX IF NOT EXISTS movie_listings_channel ON movie_listings (channel)',
+    'CREATE INDEX IF NOT EXISTS movies_listing ON movies (listing_id)',
+)
+
+# EntityMemo kinds to their table
+ENTITY_TABLES = {
+    'series': 'series',
+    'movie_listings': 'movie_listings',
+    'seasons': 'seasons',
+    'episodes': 'episodes',
+    'movies': 'movies',
+}
+
+# most pages refresh_listing reads of a channel listing
+REFRESH_MAX_PAGES = 10
+
+# how much a hit in the title, keywords and description columns of search_index counts
+SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+
+
+def search_rank(matchinfo):
+    """
+    SQLite function scoring a row from matchinfo(search_index, 'pcx')
+    Hits are weighted by column and by how rare the term is across the index
+    """
+    info = array('I', str(matchinfo))
+    phrases, columns = info[0], info[1]
+    score = 0.0
+    for phrase in range(phrases):
+        for column in range(columns):
+            offset = 2 + 3 * (phrase * columns + column)
+            hits, total = info[offset], info[offset + 1]
+            if hits:
+                score += SEARCH_WEIGHTS[column] * hits / float(total)
+    return score
+
+
+def search_kind(doc):
+    """
+    :param doc: raw panel or CMS document
+    :return: kind the document is indexed under, panels count as the resource they point to
+    """
+    if doc.get('__class__') == 'panel':
+        return doc.get('type')
+    return doc.get('__class__')
+
+
+class Catalog(object):
+    """
+    Stores the raw CMS documents next to the columns needed to list them,
+    reads hand back the same objects vrv_json_hook would
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('search_rank', 1, search_rank)
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _write(self, statement, rows):
+        conn = self._db()
+        conn.executemany(statement, rows)
+        conn.commit()
+
+    def _objects(self, statement, args=(), column=0):
+        return [vrv_json_hook(json.loads(row[column])) for row in self._db().execute(statement, args)
+                if row[column]]
+
+    # writes
+
+    def put_channels(self, channels):
+        """
+        :param channels: raw channel documents
+        """
+        conn = self._db()
+        for channel in channels:
+            if not channel.get('cms_id'):
+                continue
+            conn.execute('INSERT OR IGNORE INTO channels (id) VALUES (?)', (channel.get('cms_id'),))
+            conn.execute('UPDATE channels SET cms_id = ?, name = ?, data = ? WHERE id = ?',
+                         (channel.get('cms_id'), channel.get('name', channel.get('id')), json.dumps(channel),
+                          channel.get('cms_id')))
+        conn.commit()
+
+    def mark_channel(self, cms_id):
+        self._write('UPDATE channels SET refreshed = ? WHERE id = ?', [(time.time(), cms_id)])
+
+    def put_series_panels(self, channel, panels):
+        """
+        :param channel: cms_id of the channel the panels were listed under
+        :param panels: raw series panels from the channel listing
+        """
+        now = time.time()
+        conn = self._db()
+        for sequence, panel in enumerate(panels):
+            metadata = panel.get('series_metadata') or {}
+            conn.execute('INSERT OR IGNORE INTO series (id) VALUES (?)', (panel.get('id'),))
+            conn.execute('UPDATE series SET channel = ?, sequence = ?, title = ?, episode_count = ?, '
+                         'season_count = ?, panel = ?, updated = ? WHERE id = ?',
+                         (channel, sequence, panel.get('title'), metadata.get('episode_count'),
+                          metadata.get('season_count'), json.dumps(panel), now, panel.get('id')))
+        conn.commit()
+        self.index_documents(panels)
+
+    def put_series(self, series):
+        self._write('UPDATE series SET data = ?, updated = ? WHERE id = ?',
+                    [(json.dumps(series), time.time(), series.get('id'))])
+        self.index_documents([series])
+
+    def put_seasons(self, series_id, seasons):
+        now = time.time()
+        self._write('INSERT OR REPLACE INTO seasons VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(season.get('id'), series_id, sequence, season.get('season_number'), season.get('title'),
+                      int(bool(season.get('is_complete'))), json.dumps(season), now)
+                     for sequence, season in enumerate(seasons)])
+
+    def put_episodes(self, season_id, episodes):
+        now = time.time()
+        self._write('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(episode.get('id'), season_id, episode.get('series_id'), sequence,
+                      episode.get('episode_number'), episode.get('title'), json.dumps(episode), now)
+                     for sequence, episode in enumerate(episodes)])
+        self.index_documents(episodes)
+
+    def put_movie_listing_panels(self, channel, panels):
+        now = time.time()
+        conn = self._db()
+        for sequence, panel in enumerate(panels):
+            conn.execute('INSERT OR IGNORE INTO movie_listings (id) VALUES (?)', (panel.get('id'),))
+            conn.execute('UPDATE movie_listings SET channel = ?, sequence = ?, title = ?, panel = ?, updated = ? '
+                         'WHERE id = ?',
+                         (channel, sequence, panel.get('title'), json.dumps(panel), now, panel.get('id')))
+        conn.commit()
+        self.index_documents(panels)
+
+    def put_movie_listing(self, listing):
+        self._write('UPDATE movie_listings SET data = ?, updated = ? WHERE id = ?',
+                    [(json.dumps(listing), time.time(), listing.get('id'))])
+        self.index_documents([listing])
+
+    def put_movies(self, listing_id, movies):
+        now = time.time()
+        self._write('INSERT OR REPLACE INTO movies VALUES (?, ?, ?, ?, ?, ?)',
+                    [(movie.get('id'), listing_id, sequence, movie.get('title'), json.dumps(movie), now)
+                     for sequence, movie in enumerate(movies)])
+        self.index_documents(movies)
+
+    def remove_series(self, series_ids):
+        conn = self._db()
+        for series_id in series_ids:
+            conn.execute('DELETE FROM episodes WHERE series_id = ?', (series_id,))
+            conn.execute('DELETE FROM seasons WHERE series_id = ?', (series_id,))
+            conn.execute('DELETE FROM series WHERE id = ?', (series_id,))
+        conn.commit()
+        self.unindex('series', series_ids)
+
+    def remove_movie_listings(self, listing_ids):
+        conn = self._db()
+        for listing_id in listing_ids:
+            conn.execute('DELETE FROM movies WHERE listing_id = ?', (listing_id,))
+            conn.execute('DELETE FROM movie_listings WHERE id = ?', (listing_id,))
+        conn.commit()
+        self.unindex('movie_listing', listing_ids)
+
+    # search
+
+    def index_documents(self, docs):
+        """
+        Add or refresh documents in the full text index
+        Panels and episode or movie documents are kept so search hits can be rendered without a request,
+        series and movie listing documents only add their keywords and description to what a panel stored.
+        :param docs: raw panels or CMS documents
+        """
+        conn = self._db()
+        for doc in docs:
+            kind = search_kind(doc)
+            if not (kind and doc.get('id')):
+                continue
+            keywords = doc.get('keywords')
+            if isinstance(keywords, list):
+                keywords = u' '.join(keywords)
+            data = None
+            if doc.get('__class__') == 'panel' or kind in ('episode', 'movie'):
+                data = json.dumps(doc)
+            row = conn.execute('SELECT docid FROM search_docs WHERE kind = ? AND entity_id = ?',
+                               (kind, doc.get('id'))).fetchone()
+            if row:
+                docid = row[0]
+                if data:
+                    conn.execute('UPDATE search_docs SET data = ? WHERE docid = ?', (data, docid))
+                if keywords is None:
+                    old = conn.execute('SELECT keywords FROM search_index WHERE docid = ?', (docid,)).fetchone()
+                    keywords = old and old[0]
+                conn.execute('DELETE FROM search_index WHERE docid = ?', (docid,))
+            else:
+                docid = conn.execute('INSERT INTO search_docs (kind, entity_id, data) VALUES (?, ?, ?)',
+                                     (kind, doc.get('id'), data)).lastrowid
+            conn.execute('INSERT INTO search_index (docid, title, keywords, description) VALUES (?, ?, ?, ?)',
+                         (docid, doc.get('title'), keywords, doc.get('description')))
+        conn.commit()
+
+    def unindex(self, kind, entity_ids):
+        conn = self._db()
+        for entity_id in entity_ids:
+            row = conn.execute('SELECT docid FROM search_docs WHERE kind = ? AND entity_id = ?',
+                               (kind, entity_id)).fetchone()
+            if row:
+                conn.execute('DELETE FROM search_index WHERE docid = ?', (row[0],))
+                conn.execute('DELETE FROM search_docs WHERE docid = ?', (row[0],))
+        conn.commit()
+
+    def search(self, query, limit=50):
+        """
+        :param query: words to look for, each one matches as a prefix
+        :return: Panel, Episode and Movie objects, best matches first
+        """
+        words = re.findall(r'\w+', query, re.UNICODE)
+        if not words:
+            return []
+        match = u' '.join(word + u'*' for word in words)
+        return self._objects('SELECT search_docs.data FROM search_index '
+                             'JOIN search_docs ON search_docs.docid = search_index.docid '
+                             'WHERE search_index MATCH ? '
+                             'ORDER BY search_rank(matchinfo(search_index, \'pcx\')) DESC LIMIT ?',
+                             (match, limit))
+
+    # crawl bookkeeping
+
+    def start_run(self):
+        """
+        :return: id of the unfinished crawl run to resume, or of a new one
+        """
+        conn = self._db()
+        row = conn.execute('SELECT id FROM crawl_runs WHERE finished IS NULL ORDER BY id DESC').fetchone()
+        if row:
+            return row[0]
+        run_id = conn.execute('INSERT INTO crawl_runs (started) VALUES (?)', (time.time(),)).lastrowid
+        conn.commit()
+        return run_id
+
+    def finish_run(self, run_id):
+        conn = self._db()
+        conn.execute('UPDATE crawl_runs SET finished = ? WHERE id = ?', (time.time(), run_id))
+        conn.execute('DELETE FROM crawl_progress WHERE run_id = ?', (run_id,))
+        conn.commit()
+
+    def done(self, run_id, kind, entity_id):
+        self._write('INSERT OR IGNORE INTO crawl_progress VALUES (?, ?, ?)', [(run_id, kind, entity_id)])
+
+    def is_done(self, run_id, kind, entity_id):
+        return self._db().execute('SELECT 1 FROM crawl_progress WHERE run_id = ? AND kind = ? AND id = ?',
+                                  (run_id, kind, entity_id)).fetchone() is not None
+
+    def claim(self, key, seconds):
+        """
+        Claim key for seconds, so separate plugin runs don't start the same background work
+        :return: True if no other claim on key was still running
+        """
+        now = time.time()
+        conn = self._db()
+        conn.execute('DELETE FROM claims WHERE key = ? AND until <= ?', (key, now))
+        taken = conn.execute('INSERT OR IGNORE INTO claims VALUES (?, ?)', (key, now + seconds)).rowcount
+        conn.commit()
+        return taken > 0
+
+    def record_changes(self, changes):
+        """
+        :param changes: (kind, entity id, change, detail) tuples, change is one of added, updated or removed
+        """
+        now = time.time()
+        self._write('INSERT INTO changes (at, kind, entity_id, change, detail) VALUES (?, ?, ?, ?, ?)',
+                    [(now,) + tuple(change) for change in changes])
+
+    def changes(self, since=0):
+        """
+        :return: (time, kind, entity id, change, detail) tuples recorded after since, oldest first
+        """
+        return self._db().execute('SELECT at, kind, entity_id, change, detail FROM changes WHERE at > ? ORDER BY id',
+                                  (since,)).fetchall()
+
+    def series_counts(self, cms_id):
+        """
+        :return: dictionary of series id to (episode_count, season_count) for the series stored under a channel
+        """
+        return dict((row[0], (row[1], row[2])) for row in self._db().execute(
+            'SELECT id, episode_count, season_count FROM series WHERE channel = ?', (cms_id,)))
+
+    def listing_ids(self, cms_id):
+        """
+        :return: ids of the movie listings that were crawled completely
+        """
+        return set(row[0] for row in self._db().execute(
+            'SELECT id FROM movie_listings WHERE channel = ? AND data IS NOT NULL', (cms_id,)))
+
+    def incomplete_seasons(self, series_id):
+        """
+        :return: ids of the series' seasons that are still airing
+        """
+        return [row[0] for row in self._db().execute(
+            'SELECT id FROM seasons WHERE series_id = ? AND NOT is_complete ORDER BY sequence', (series_id,))]
+
+    # reads
+
+    def channels(self):
+        return self._objects('SELECT data FROM channels ORDER BY name')
+
+    def channel_refreshed(self, cms_id):
+        """
+        :return: when the channel or one of its listings was last read completely, or None
+        """
+        row = self._db().execute('SELECT refreshed FROM channels WHERE id = ?', (cms_id,)).fetchone()
+        return row[0] if row else None
+
+    def season_updated(self, season_id):
+        """
+        :return: when the season's episodes were last stored, or None
+        """
+        return self._db().execute('SELECT MIN(updated) FROM episodes WHERE season_id = ?', (season_id,)).fetchone()[0]
+
+    def channel_series(self, cms_id):
+        """
+        :return: the channel's series as Panel objects, in listing order
+        """
+        return self._objects('SELECT panel FROM series WHERE channel = ? ORDER BY sequence', (cms_id,))
+
+    def channel_movie_listings(self, cms_id):
+        return self._objects('SELECT panel FROM movie_listings WHERE channel = ? ORDER BY sequence', (cms_id,))
+
+    def series_seasons(self, series_id):
+        return self._objects('SELECT data FROM seasons WHERE series_id = ? ORDER BY sequence', (series_id,))
+
+    def season_episodes(self, season_id):
+        return self._objects('SELECT data FROM episodes WHERE season_id = ? ORDER BY sequence', (season_id,))
+
+    def listing_movies(self, listing_id):
+        return self._objects('SELECT data FROM movies WHERE listing_id = ? ORDER BY sequence', (listing_id,))
+
+    def entity(self, kind, entity_id):
+        """
+        :param kind: CMS collection as used by EntityMemo, e.g. series or movie_listings
+        :return: the hydrated entity or None
+        """
+        table = ENTITY_TABLES.get(kind)
+        if not table:
+            return None
+        found = self._objects('SELECT data FROM {} WHERE id = ?'.format(table), (entity_id,))
+        if found:
+            return found[0]
+        return None
+
+
+class Crawler(object):
+    """
+    Walks channels -> series -> seasons -> episodes and channels -> movie listings -> movies into a Catalog
+    Series and movie listings are crawled on a bounded pool. Finished ones are recorded per crawl run,
+    so a crawl that was stopped picks up where it left off. Once the catalog is filled, sync keeps it
+    current for a fraction of the requests.
+    """
+
+    def __init__(self, vrv_session, catalog, workers=3, progress=None, should_stop=None, page_size=50):
+        """
+        :param vrv_session: logged in VRV instance
+        :param catalog: Catalog to fill
+        :param workers: most series or movie listings crawled at once
+        :param progress: called with a message and a percentage
+        :param should_stop: returns True when the crawl has to stop, e.g. on Kodi shutdown
+        :param page_size: items per listing page
+        """
+        self.vrv_session = vrv_session
+        self.catalog = catalog
+        self.pool = WorkerPool(workers)
+        self.progress = progress or (lambda message, percent: None)
+        self.should_stop = should_stop or (lambda: False)
+        self.page_size = page_size
+
+    def _get(self, path):
+        """
+        The crawler always goes to the network, the catalog is its cache
+        :return: the raw document at path or None
+        """
+        if not path:
+            return None
+        res = self.vrv_session.get_cms(path, match_type=False, use_cache=False)
+        if type(res) == dict:
+            return res
+        return None
+
+    def _items(self, path):
+        """
+        :return: tuple of the items of every page and whether all pages could be read
+        """
+        fetch = lambda page_path: self.vrv_session.get_cms(page_path, match_type=False, use_cache=False)
+        pages = self.vrv_session.paginate(path, fetch=fetch)
+        items = list(pages)
+        # a page that failed leaves next_path pointing at it
+        return items, type(pages.first_page) == dict and not pages.next_path
+
+    def crawl(self, channel_ids=None):
+        """
+        :param channel_ids: cms ids of the channels to crawl, all of them by default
+        :return: True if the crawl ran to the end
+        """
+        run_id = self.catalog.start_run()
+        channels_doc = self._get(self.vrv_session.links.get('channels'))
+        if not channels_doc:
+            return False
+        channels = channels_doc.get('items') or []
+        self.catalog.put_channels(channels)
+        cms_ids = [c.get('cms_id') for c in channels if c.get('cms_id')]
+        if channel_ids:
+            cms_ids = [c for c in cms_ids if c in channel_ids]
+        for position, cms_id in enumerate(cms_ids):
+            if self.should_stop():
+                return False
+            if self.catalog.is_done(run_id, 'channel', cms_id):
+                continue
+            self.progress(cms_id, int(100 * position / len(cms_ids)))
+            if not self.crawl_channel(run_id, cms_id):
+                return False
+        self.catalog.finish_run(run_id)
+        self.progress('', 100)
+        return True
+
+    def crawl_channel(self, run_id, cms_id):
+        """
+        :return: False if the crawl was stopped part way
+        """
+        cms_url = self.vrv_session.cms_url
+        panels, _ = self._items('{}series?channel_id={}&mode=channel&limit={}'.format(cms_url, cms_id,
+                                                                                      self.page_size))
+        self.catalog.put_series_panels(cms_id, panels)
+        self.pool.map(lambda panel: self.crawl_series(run_id, panel.get('id')),
+                      [p for p in panels if not self.catalog.is_done(run_id, 'series', p.get('id'))])
+        listings, _ = self._items('{}movie_listings?channel_id={}&mode=channel&limit={}'.format(cms_url, cms_id,
+                                                                                                self.page_size))
+        self.catalog.put_movie_listing_panels(cms_id, listings)
+        self.pool.map(lambda panel: self.crawl_movie_listing(run_id, panel.get('id')),
+                      [p for p in listings if not self.catalog.is_done(run_id, 'movie_listing', p.get('id'))])
+        if self.should_stop():
+            return False
+        self.catalog.mark_channel(cms_id)
+        self.catalog.done(run_id, 'channel', cms_id)
+        return True
+
+    def crawl_series(self, run_id, series_id):
+        """
+        :param run_id: crawl run the series is recorded in once done, None when syncing
+        """
+        if self.should_stop():
+            return
+        cms_url = self.vrv_session.cms_url
+        series = self._get(cms_url + 'series/' + series_id)
+        if series:
+            self.catalog.put_series(series)
+        seasons = self._get(cms_url + 'seasons?series_id=' + series_id)
+        if not seasons:
+            return
+        season_items = seasons.get('items') or []
+        self.catalog.put_seasons(series_id, season_items)
+        for season in season_items:
+            self.crawl_season(season.get('id'))
+        if run_id is not None:
+            self.catalog.done(run_id, 'series', series_id)
+
+    def sync(self, channel_ids=None):
+        """
+        Bring an existing catalog up to date without walking every series again
+        Only channel listings are re-read in full. A series is descended into when it is new or its episode or
+        season count changed, otherwise only its seasons that are not complete get their episodes refreshed.
+        New movie listings are crawled, ones that left the channel are removed. Everything that changed is
+        recorded in the changes table.
+        :param channel_ids: cms ids of the channels to sync, all of them by default
+        :return: True if the sync ran to the end
+        """
+        channels_doc = self._get(self.vrv_session.links.get('channels'))
+        if not channels_doc:
+            return False
+        channels = channels_doc.get('items') or []
+        self.catalog.put_channels(channels)
+        cms_ids = [c.get('cms_id') for c in channels if c.get('cms_id')]
+        if channel_ids:
+            cms_ids = [c for c in cms_ids if c in channel_ids]
+        for position, cms_id in enumerate(cms_ids):
+            if self.should_stop():
+                return False
+            self.progress(cms_id, int(100 * position / len(cms_ids)))
+            if not self.sync_channel(cms_id):
+                return False
+        self.progress('', 100)
+        return True
+
+    def sync_channel(self, cms_id):
+        """
+        :return: False if the sync was stopped part way
+        """
+        cms_url = self.vrv_session.cms_url
+        known = self.catalog.series_counts(cms_id)
+        panels, complete = self._items('{}series?channel_id={}&mode=channel&limit={}'.format(cms_url, cms_id,
+                                                                                             self.page_size))
+        if not panels and known:
+            # an empty listing is far more likely a failed request than a channel without series
+            return True
+        changes = []
+        changed = []
+        unchanged = []
+        for panel in panels:
+            metadata = panel.get('series_metadata') or {}
+            counts = (metadata.get('episode_count'), metadata.get('season_count'))
+            if panel.get('id') not in known:
+                changes.append(('series', panel.get('id'), 'added', panel.get('title')))
+                changed.append(panel.get('id'))
+            elif known[panel.get('id')] != counts:
+                changes.append(('series', panel.get('id'), 'updated',
+                                'episodes {} -> {}, seasons {} -> {}'.format(known[panel.get('id')][0], counts[0],
+                                                                            known[panel.get('id')][1], counts[1])))
+                changed.append(panel.get('id'))
+            else:
+                unchanged.append(panel.get('id'))
+        # series past a page that failed are still there as far as anyone knows
+        removed = set(known) - set(p.get('id') for p in panels) if complete else set()
+        changes += [('series', series_id, 'removed', None) for series_id in removed]
+        self.catalog.remove_series(removed)
+        self.catalog.put_series_panels(cms_id, panels)
+        self.pool.map(lambda series_id: self.crawl_series(None, series_id), changed)
+        seasons = []
+        for series_id in unchanged:
+            seasons += self.catalog.incomplete_seasons(series_id)
+        self.pool.map(self.crawl_season, seasons)
+
+        known_listings = self.catalog.listing_ids(cms_id)
+        listings, listings_complete = self._items('{}movie_listings?channel_id={}&mode=channel&limit={}'.format(
+            cms_url, cms_id, self.page_size))
+        if listings or not known_listings:
+            added = [p.get('id') for p in listings if p.get('id') not in known_listings]
+            removed = known_listings - set(p.get('id') for p in listings) if listings_complete else set()
+            changes += [('movie_listing', listing_id, 'added', None) for listing_id in added]
+            changes += [('movie_listing', listing_id, 'removed', None) for listing_id in removed]
+            self.catalog.remove_movie_listings(removed)
+            self.catalog.put_movie_listing_panels(cms_id, listings)
+            self.pool.map(lambda listing_id: self.crawl_movie_listing(None, listing_id), added)
+        self.catalog.record_changes(changes)
+        if self.should_stop():
+            return False
+        if complete and listings_complete:
+            # a listing read in part gets read again on the next sync
+            self.catalog.mark_channel(cms_id)
+        return True
+
+    def refresh_listing(self, kind, entity_id, max_pages=REFRESH_MAX_PAGES):
+        """
+        Read again one listing that was served from the catalog, without descending into what it lists
+        :param kind: series or movie_listings for the listings of a channel, episodes for those of a season
+        :param entity_id: cms id of the channel, or id of the season
+        :param max_pages: most pages read of a channel listing, entries past them are kept as they are
+        :return: True if the listing was refreshed
+        """
+        if self.should_stop():
+            return False
+        if kind == 'episodes':
+            self.crawl_season(entity_id)
+            return True
+        if kind not in ('series', 'movie_listings'):
+            return False
+        fetch = lambda page_path: None if self.should_stop() else \
+            self.vrv_session.get_cms(page_path, match_type=False, use_cache=False)
+        pages = self.vrv_session.paginate('{}{}?channel_id={}&mode=channel&limit={}'.format(
+            self.vrv_session.cms_url, kind, entity_id, self.page_size), fetch=fetch, prefetch=False,
+            max_pages=max_pages)
+        panels = list(pages)
+        if not panels or self.should_stop():
+            return False
+        # entries missing from a listing cut short by max_pages may still be in it
+        complete = not pages.next_path
+        listed = set(p.get('id') for p in panels)
+        if kind == 'series':
+            removed = set(self.catalog.series_counts(entity_id)) - listed if complete else set()
+            self.catalog.remove_series(removed)
+            self.catalog.put_series_panels(entity_id, panels)
+            self.catalog.record_changes([('series', series_id, 'removed', None) for series_id in removed])
+        else:
+            removed = self.catalog.listing_ids(entity_id) - listed if complete else set()
+            self.catalog.remove_movie_listings(removed)
+            self.catalog.put_movie_listing_panels(entity_id, panels)
+            self.catalog.record_changes([('movie_listing', listing_id, 'removed', None) for listing_id in removed])
+        self.catalog.mark_channel(entity_id)
+        return True
+
+    def crawl_season(self, season_id):
+        episodes = self._get(self.vrv_session.cms_url + 'episodes?season_id=' + season_id)
+        if episodes:
+            self.catalog.put_episodes(season_id, episodes.get('items') or [])
+
+    def crawl_movie_listing(self, run_id, listing_id):
+        if self.should_stop():
+            return
+        listing = self._get(self.vrv_session.cms_url + 'movie_listings/' + listing_id)
+        if not listing:
+            return
+        self.catalog.put_movie_listing(listing)
+        movies = self._get(process_movies_path(listing))
+        if movies:
+            self.catalog.put_movies(listing_id, movies.get('items') or [])
+        if run_id is not None:
+            self.catalog.done(run_id, 'movie_listing', listing_id)
+
+
+def process_movies_path(listing):
+    """
+    :param listing: raw movie listing document
+    :return: path of its movies collection
+    """
+    link = (listing.get('__links__') or {}).get('movie_listing/movies')
+    if link:
+        return link.get('href')
+    return None
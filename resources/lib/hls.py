@@ -0,0 +1,181 @@
+"""
+hls.py
+Variant streams of HLS master playlists for non-adaptive playback
+Only the #EXT-X-STREAM-INF lines and the uris after them are read, and the variants of a master playlist are
+kept until its signed url runs out.
+"""
+import base64
+import json
+import re
+import time
+from urllib import unquote
+from urlparse import urljoin, urlparse, parse_qs
+
+from vrvstore import JSONStore
+
+# seconds a master playlist is kept when its url carries no expiry
+DEFAULT_TTL = 3600
+
+# seconds before expiry at which cached variants are no longer handed out
+EXPIRY_MARGIN = 300
+
+# share of the measured throughput a variant's bandwidth may take, the rest absorbs fluctuations
+SAFETY_MARGIN = 0.75
+
+ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class Variant(object):
+    __slots__ = ('uri', 'bandwidth', 'width', 'height')
+
+    def __init__(self, uri, bandwidth=0, width=0, height=0):
+        self.uri = uri
+        self.bandwidth = bandwidth
+        self.width = width
+        self.height = height
+
+    def to_list(self):
+        return [self.uri, self.bandwidth, self.width, self.height]
+
+    def __repr__(self):
+        return u'<Variant: {}x{} {}bps>'.format(self.width, self.height, self.bandwidth)
+
+
+def parse_attributes(text):
+    """
+    :param text: attribute list of a tag, such as BANDWIDTH=1200000,RESOLUTION=1280x720,CODECS="avc1,mp4a"
+    :return: dictionary of attribute name to value, quotes removed
+    """
+    return dict((name, value.strip('"')) for name, value in ATTRIBUTE.findall(text))
+
+
+def parse_master(lines, base_url):
+    """
+    :param lines: lines of a master playlist, read as they arrive
+    :param base_url: url of the playlist, relative variant uris are resolved against it
+    :return: list of Variant
+    """
+    variants = []
+    attributes = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line[len('#EXT-X-STREAM-INF:'):])
+        elif attributes is not None and line and not line.startswith('#'):
+            width, _, height = attributes.get('RESOLUTION', '').partition('x')
+            variants.append(Variant(urljoin(base_url, line), int(attributes.get('BANDWIDTH') or 0),
+                                    int(width or 0), int(height or 0)))
+            attributes = None
+    return variants
+
+
+def url_expires(url):
+    """
+    :param url: signed url, with an Expires argument or a CloudFront Policy
+    :return: UTC timestamp at which the signature runs out, None if the url doesn't say
+    """
+    args = parse_qs(urlparse(url).query)
+    if args.get('Expires'):
+        try:
+            return int(args['Expires'][0])
+        except ValueError:
+            pass
+    if args.get('Policy'):
+        policy = unquote(args['Policy'][0]).replace('-', '+').replace('_', '=').replace('~', '/')
+        try:
+            statement = json.loads(base64.b64decode(policy))['Statement'][0]
+            return int(statement['Condition']['DateLessThan']['AWS:EpochTime'])
+        except (TypeError, ValueError, KeyError, IndexError):
+            pass
+    return None
+
+
+def select_variant(variants, throughput=None, max_height=0, margin=SAFETY_MARGIN):
+    """
+    :param throughput: measured bits per second, None picks the highest variant max_height allows
+    :param max_height: highest resolution to pick, 0 for no cap
+    :param margin: share of throughput the variant's bandwidth may take
+    :return: the highest variant within both limits, the lowest one if none fits, None without variants
+    """
+    if not variants:
+        return None
+    lowest = min(variants, key=lambda v: (v.bandwidth, v.height))
+    allowed = [v for v in variants if not max_height or v.height <= max_height]
+    if throughput:
+        allowed = [v for v in allowed if v.bandwidth <= throughput * margin]
+    if not allowed:
+        return lowest
+    return max(allowed, key=lambda v: (v.height, v.bandwidth))
+
+
+def probe_segment(url, http, meter):
+    """
+    Time the download of the first segment of a variant playlist
+    :param meter: ThroughputMeter the download is recorded in
+    """
+    response = http.get(url)
+    if response.status_code != 200:
+        return
+    for line in response.content.splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            meter.get(http, urljoin(url, line))
+            return
+
+
+class VariantCache(JSONStore):
+    """
+    Variants of master playlists by url without its signing arguments
+    The playlist of an episode keeps its path when it is signed again, so a fresh streams response still finds
+    the variants that were read, or prefetched, with an earlier signature.
+    """
+
+    @staticmethod
+    def key(url):
+        return url.split('?', 1)[0]
+
+    def get(self, url):
+        """
+        :return: list of Variant, or None if the playlist isn't cached or its signature is about to run out
+        """
+        entry = (self.load() or {}).get(self.key(url))
+        if not entry or entry['expires'] - EXPIRY_MARGIN <= time.time():
+            return None
+        return [Variant(*variant) for variant in entry['variants']]
+
+    def put(self, url, variants):
+        now = time.time()
+        data = dict((key, entry) for key, entry in (self.load() or {}).items() if entry['expires'] > now)
+        # the variant uris are signed on their own and may run out first
+        expiries = [stamp for stamp in [url_expires(url)] + [url_expires(v.uri) for v in variants] if stamp]
+        data[self.key(url)] = {
+            'expires': min(expiries) if expiries else now + DEFAULT_TTL,
+            'variants': [variant.to_list() for variant in variants]
+        }
+        self.save(data)
+
+    def variants(self, url, http, meter=None):
+        """
+        :param http: requests session the playlist is fetched with when it isn't cached
+        :param meter: ThroughputMeter the download is recorded in
+        :return: list of Variant, empty if the playlist couldn't be read
+        """
+        variants = self.get(url)
+        if variants is None:
+            started = time.time()
+            response = http.get(url, stream=True)
+            if response.status_code != 200:
+                return []
+            received = [0]
+
+            def lines():
+                for line in response.iter_lines():
+                    received[0] += len(line) + 1
+                    yield line
+
+            variants = parse_master(lines(), url)
+            if meter:
+                meter.record(received[0], time.time() - started)
+            if variants:
+                self.put(url, variants)
+        return variants
@@ -0,0 +1,180 @@
+"""
+httpcache.py
+SQLite cache for CMS responses, keyed by the unsigned path
+"""
+import json
+import sqlite3
+import threading
+import time
+
+
+# seconds a response stays fresh, by its __class__
+# a ttl of 0 means responses of that class are never stored
+DEFAULT_TTLS = {
+    'series': 86400,
+    'movie_listing': 86400,
+    'movie': 86400,
+    'channel': 86400,
+    'core.channel': 86400,
+    'season': 21600,
+    'episode': 3600,
+    'panel': 3600,
+    'collection': 900,
+    'curated_feed': 1800,
+    'video_streams': 0,
+    'index': 0,
+}
+
+DEFAULT_TTL = 600
+
+# paths containing any of these are always fetched from the network
+VOLATILE_PATHS = ('/playheads', '/watchlist', '/search')
+
+
+class ResponseCache(object):
+    """
+    Stores decoded CMS responses together with their ETag and Last-Modified headers
+    Expired entries are kept so they can be revalidated with a conditional GET
+    """
+
+    def __init__(self, path, ttls=None, default_ttl=DEFAULT_TTL, volatile=VOLATILE_PATHS):
+        """
+        :param path: SQLite database file
+        :param ttls: overrides for DEFAULT_TTLS
+        :param default_ttl: ttl for classes that are not listed
+        :param volatile: path fragments that bypass the cache
+        """
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.volatile = volatile
+        self._local = threading.local()
+
+    def _db(self):
+        """
+        :return: a connection owned by the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # several worker threads write here at once, WAL lets them do it without blocking readers
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'path TEXT PRIMARY KEY, rclass TEXT, body TEXT, etag TEXT, last_modified TEXT, '
+                         'stored REAL, expires REAL)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(path):
+        """
+        :param path: CMS path or full URL without signing arguments
+        :return: the cache key for path
+        """
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        return path
+
+    def cacheable(self, path):
+        for fragment in self.volatile:
+            if fragment in path:
+                return False
+        return True
+
+    def ttl(self, rclass):
+        return self.ttls.get(rclass, self.default_ttl)
+
+    def get(self, path):
+        """
+        :param path: unsigned CMS path
+        :return: dict with body, etag, last_modified, stored and fresh or None
+        """
+        try:
+            row = self._db().execute('SELECT * FROM responses WHERE path = ?', (self.key(path),)).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+        return {
+            'body': json.loads(row['body']),
+            'rclass': row['rclass'],
+            'etag': row['etag'],
+            'last_modified': row['last_modified'],
+            'stored': row['stored'],
+            'fresh': row['expires'] > time.time()
+        }
+
+    @staticmethod
+    def validators(entry):
+        """
+        :param entry: an expired entry from get
+        :return: headers for a conditional GET
+        """
+        headers = dict()
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, path, body, headers=None, keep=False):
+        """
+        :param path: unsigned CMS path
+        :param body: decoded JSON response
+        :param headers: response headers, used for ETag and Last-Modified
+        :param keep: store responses that are never cached as well, already expired, so they can only be
+            served stale
+        """
+        rclass = body.get('__class__') if type(body) == dict else None
+        ttl = self.ttl(rclass)
+        if keep and (ttl <= 0 or not self.cacheable(path)):
+            ttl = 0
+        elif ttl <= 0:
+            return
+        headers = headers or {}
+        now = time.time()
+        try:
+            conn = self._db()
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (self.key(path), rclass, json.dumps(body), headers.get('ETag'),
+                          headers.get('Last-Modified'), now, now + ttl))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def touch(self, path, rclass):
+        """
+        Mark an entry fresh again after the server answered 304 Not Modified
+        """
+        now = time.time()
+        try:
+            conn = self._db()
+            conn.execute('UPDATE responses SET stored = ?, expires = ? WHERE path = ?',
+                         (now, now + self.ttl(rclass), self.key(path)))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def forget(self, fragment):
+        """
+        Drop every entry whose path contains fragment
+        """
+        try:
+            conn = self._db()
+            conn.execute('DELETE FROM responses WHERE path LIKE ?', ('%' + fragment + '%',))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            conn = self._db()
+            conn.execute('DELETE FROM responses')
+            conn.commit()
+        except sqlite3.Error:
+            pass
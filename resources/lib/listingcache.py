@@ -0,0 +1,86 @@
+"""
+listingcache.py
+SQLite cache for the rendered entries of plugin listings, keyed by route path and arguments
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from urllib import urlencode
+
+
+class ListingCache(object):
+    """
+    Stores the finished entries of a listing so a later visit can hand them straight to Kodi
+    Entries are dictionaries with everything needed to build a ListItem, anything that changes between
+    visits, like playhead status, is left for the caller to fill in when replaying them.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        """
+        :return: a connection owned by the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS listings ('
+                         'key TEXT PRIMARY KEY, entries TEXT, stored REAL, expires REAL)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(path, args=None):
+        """
+        :param path: route path as made by plugin.url_for, without the query string
+        :param args: query arguments of the route, as in plugin.args
+        :return: the cache key of the listing
+        """
+        path = path.split('?', 1)[0]
+        if not args:
+            return path
+        pairs = []
+        for name in sorted(args):
+            values = args[name]
+            for value in (values if isinstance(values, (list, tuple)) else [values]):
+                pairs.append((name, value.encode('utf-8') if isinstance(value, unicode) else value))
+        return path + '?' + urlencode(pairs)
+
+    def get(self, key):
+        """
+        :return: the stored entries while they are fresh, otherwise None
+        """
+        try:
+            row = self._db().execute('SELECT entries FROM listings WHERE key = ? AND expires > ?',
+                                     (key, time.time())).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+        return json.loads(row['entries'])
+
+    def put(self, key, entries, ttl):
+        """
+        :param entries: list of JSON serializable entry dictionaries
+        :param ttl: seconds the entries may be replayed for
+        """
+        now = time.time()
+        try:
+            conn = self._db()
+            conn.execute('DELETE FROM listings WHERE expires <= ?', (now,))
+            conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(entries), now, now + ttl))
+            conn.commit()
+        except (sqlite3.Error, TypeError, ValueError):
+            pass
@@ -0,0 +1,187 @@
+"""
+playheads.py
+Local playhead table and the write-behind queue that sends it to VRV
+Positions are checkpointed here during playback and posted in the background, one update per video however
+often it was checkpointed. Updates that could not be sent stay queued for the next flush, even across restarts.
+"""
+import sqlite3
+import threading
+import time
+
+from vrvlib import PlayHead
+
+# seconds before the first retry of a failed update, doubled with every further failure
+RETRY_BACKOFF = 30
+MAX_BACKOFF = 3600
+
+# client errors that are only retried after the backoff, a 401 is retried with a new login and any other 4xx
+# answer drops the update
+RETRY_STATUS = (408, 429)
+
+
+class PlayheadStore(object):
+    """
+    Playheads by content id, both the ones waiting to be sent and ones recently read from the API
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        """
+        :return: a connection owned by the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS playheads ('
+                         'content_id TEXT PRIMARY KEY, position INTEGER, completed INTEGER, updated REAL, '
+                         'pending INTEGER, attempts INTEGER, next_try REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS playheads_pending ON playheads (pending, next_try)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def record(self, content_id, position, completed=False):
+        """
+        Checkpoint a position, replacing any update for content_id that wasn't sent yet
+        :param position: seconds into the video
+        """
+        conn = self._db()
+        conn.execute('INSERT OR REPLACE INTO playheads VALUES (?, ?, ?, ?, 1, 0, 0)',
+                     (content_id, int(position), int(bool(completed)), time.time()))
+        conn.commit()
+
+    def remember(self, content_ids, play_heads):
+        """
+        Keep playheads read from the API, without touching updates that are still to be sent
+        :param content_ids: ids the API answered for, the ones without a playhead are remembered as such
+        :param play_heads: dictionary of content id to PlayHead
+        """
+        now = time.time()
+        conn = self._db()
+        for content_id in content_ids:
+            play_head = play_heads.get(content_id)
+            row = (play_head.position if play_head else None,
+                   int(bool(play_head and play_head.completion_status)), now, content_id)
+            conn.execute('UPDATE playheads SET position = ?, completed = ?, updated = ? '
+                         'WHERE content_id = ? AND pending = 0', row)
+            conn.execute('INSERT OR IGNORE INTO playheads VALUES (?, ?, ?, ?, 0, 0, 0)',
+                         (content_id,) + row[:3])
+        conn.commit()
+
+    def get(self, content_ids, max_age):
+        """
+        :param max_age: seconds a playhead read from the API is trusted for, updates waiting to be sent always are
+        :return: dictionary of content id to PlayHead, or to None for ids known to have no playhead
+        """
+        found = dict()
+        content_ids = [x for x in content_ids if x]
+        oldest = time.time() - max_age
+        for start in range(0, len(content_ids), 500):
+            chunk = content_ids[start:start + 500]
+            rows = self._db().execute('SELECT * FROM playheads WHERE content_id IN ({}) '
+                                      'AND (pending = 1 OR updated > ?)'.format(','.join('?' * len(chunk))),
+                                      chunk + [oldest])
+            for row in rows:
+                found[row['content_id']] = None if row['position'] is None else PlayHead({
+                    'content_id': row['content_id'],
+                    'playhead': row['position'],
+                    'completion_status': bool(row['completed'])
+                })
+        return found
+
+    def due(self):
+        """
+        :return: rows of the updates that should be sent now
+        """
+        return self._db().execute('SELECT * FROM playheads WHERE pending = 1 AND next_try <= ?',
+                                  (time.time(),)).fetchall()
+
+    def sent(self, row):
+        """
+        Mark the update in row as done, unless a newer checkpoint replaced it in the meantime
+        """
+        conn = self._db()
+        conn.execute('UPDATE playheads SET pending = 0, attempts = 0 WHERE content_id = ? AND updated = ?',
+                     (row['content_id'], row['updated']))
+        conn.commit()
+
+    def retry_later(self, row):
+        conn = self._db()
+        delay = min(RETRY_BACKOFF * 2 ** row['attempts'], MAX_BACKOFF)
+        conn.execute('UPDATE playheads SET attempts = ?, next_try = ? WHERE content_id = ? AND updated = ?',
+                     (row['attempts'] + 1, time.time() + delay, row['content_id'], row['updated']))
+        conn.commit()
+
+
+class PlayheadSync(object):
+    """
+    Sends queued updates from a PlayheadStore, on demand with flush or every interval seconds with start
+    """
+
+    def __init__(self, store, vrv_session, interval=60):
+        """
+        :param store: PlayheadStore holding the updates
+        :param vrv_session: logged in VRV used to post them, it logs in again when the token is rejected
+        :param interval: seconds between flushes of the background thread
+        """
+        self.store = store
+        self.vrv_session = vrv_session
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        """
+        Post every update that is due
+        :return: number of updates sent
+        """
+        count = 0
+        for row in self.store.due():
+            try:
+                response = self.vrv_session.post_play_head(row['content_id'], row['position'])
+            except Exception:
+                response = None
+            status = getattr(response, 'status_code', 0)
+            if 200 <= status < 300:
+                self.store.sent(row)
+                count += 1
+            elif status == 401:
+                # post_play_head already logged in again, without a new token the other updates would fail
+                # as well, the next flush logs in again
+                self.store.retry_later(row)
+                break
+            elif 400 <= status < 500 and status not in RETRY_STATUS:
+                self.store.sent(row)
+            else:
+                self.store.retry_later(row)
+        return count
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.flush()
+            self._stop.wait(self.interval)
+        self.flush()
+
+    def start(self):
+        """
+        Flush now and every interval seconds on a background thread until stop
+        """
+        if self._thread is None:
+            # not a daemon, the last flush after stop should finish before the interpreter goes away
+            self._thread = threading.Thread(target=self._run)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Let the background thread flush once more and end, without waiting for it
+        """
+        self._stop.set()
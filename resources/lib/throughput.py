@@ -0,0 +1,84 @@
+"""
+throughput.py
+Smoothed estimate of the download speed, fed by the downloads the addon makes anyway
+"""
+import threading
+import time
+
+from vrvstore import JSONStore
+
+# downloads smaller than this say more about latency than about speed and are ignored
+MIN_SAMPLE_BYTES = 4 * 1024
+
+# a download of this size moves the estimate by the full SMOOTHING weight, smaller ones by less
+FULL_SAMPLE_BYTES = 512 * 1024
+SMOOTHING = 0.3
+
+
+class ThroughputMeter(JSONStore):
+    """
+    Exponentially weighted moving average of measured throughput in bits per second, kept in a JSON file
+    Samples are weighted by their size, so a stream segment counts for more than a subtitle file. The average
+    is kept in memory and written back once with persist. Only record downloads that had the link to
+    themselves: parallel downloads each see a share of it and would drag the estimate down.
+    """
+
+    def __init__(self, path):
+        super(ThroughputMeter, self).__init__(path)
+        self._lock = threading.Lock()
+        self._data = None
+        self._dirty = False
+
+    def _current(self):
+        """
+        :return: the stored average, read from disk on first use, call with the lock held
+        """
+        if self._data is None:
+            self._data = self.load() or {}
+        return self._data
+
+    def estimate(self):
+        """
+        :return: bits per second, None before the first measurement
+        """
+        with self._lock:
+            return self._current().get('bps')
+
+    def record(self, nbytes, seconds):
+        """
+        :param nbytes: size of a finished download
+        :param seconds: how long it took, from sending the request to the last byte
+        """
+        if nbytes < MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        sample = nbytes * 8 / seconds
+        weight = SMOOTHING * min(1.0, float(nbytes) / FULL_SAMPLE_BYTES)
+        with self._lock:
+            data = self._current()
+            estimate = data.get('bps')
+            if estimate is None:
+                estimate = sample
+            else:
+                estimate += weight * (sample - estimate)
+            data.update({'bps': estimate, 'samples': data.get('samples', 0) + 1, 'updated': int(time.time())})
+            self._dirty = True
+
+    def persist(self):
+        """
+        Write the average to disk if samples were recorded since it was read
+        """
+        with self._lock:
+            if self._dirty:
+                self.save(self._data)
+                self._dirty = False
+
+    def get(self, http, url):
+        """
+        GET url with http and record how fast the body came in
+        :return: the response
+        """
+        started = time.time()
+        response = http.get(url)
+        if response.status_code == 200:
+            self.record(len(response.content), time.time() - started)
+        return response
@@ -4,9 +4,12 @@ Created by scj643 on 10/19/2017
 """
 from urllib import urlencode, quote
 
-from requests_oauthlib import OAuth1Session
+from workers import WorkerPool, Task, SingleFlight
+from httpcache import ResponseCache, VOLATILE_PATHS
 from datetime import datetime
 import _strptime
+import calendar
+import threading
 import time
 
 
@@ -19,6 +22,21 @@ HEADERS = {
 
 API_URL = 'https://api.vrv.co'
 
+# smallest width in pixels wanted for each Kodi art type, sized for a 1080p skin
+ART_TARGETS = {
+    'poster': 480,
+    'banner': 800,
+    'fanart': 1280,
+    'thumb': 480,
+}
+
+# stop trusting a cached index this many seconds before its signing policies expire
+INDEX_EXPIRY_MARGIN = 300
+# start refreshing the cached index in the background this many seconds before expiry
+INDEX_REFRESH_WINDOW = 1800
+# identical CMS requests made within this many seconds of each other share one response
+COALESCE_WINDOW = 30
+
 
 def process_links(json_in):
     """
@@ -35,95 +53,442 @@ def process_links(json_in):
         return {}
 
 
+def parse_expires(expires):
+    """
+    :param expires: signing policy expiry such as 2017-10-19T04:00:00+00:00
+    :return: UTC timestamp
+    """
+    return calendar.timegm(time.strptime(expires.split('+')[0], '%Y-%m-%dT%H:%M:%S'))
+
+
 class VRV(object):
-    def __init__(self, email=None, password=None, key=None, secret=None):
+    def __init__(self, email=None, password=None, key=None, secret=None, store=None, index_cache=None,
+                 cache=None, workers=4):
+        """
+        :param store: optional CredentialStore used to reuse the OAuth token between runs
+        :param index_cache: optional IndexCache holding the core and CMS index documents
+        :param cache: optional ResponseCache for CMS GETs
+        :param workers: most requests get_cms_many runs at once
+        """
         self._oauthkey = key
         self._oauthsecret = secret
-        self.session = OAuth1Session(self._oauthkey,
-                                     client_secret=self._oauthsecret)
-        self.session.headers = {
-            'User-Agent': 'VRV/968 (iPad; iOS 10.2; Scale/2.00)',
-            'Accept-Encoding': 'gzip, deflate',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US;q=1, ja-JP;q=0.9',
-        }
+        self._email = email
+        self._password = password
+        self.store = store
+        self.index_cache = index_cache
+        self.cache = cache
+        self.memo = EntityMemo(self)
+        self.flights = SingleFlight()
+        self.workers = workers
+        self._pool = None
+        self._local = threading.local()
+        self._owner = threading.current_thread()
+        self._login_lock = threading.Lock()
+        self._token = None
+        self._token_secret = None
+        self._session = None
         self.api_url = 'https://api.vrv.co'
         self.index_path = '/core/index?'
-        self.index = Index(self.session.get(self.api_url + self.index_path).json())
-        self.actions = self.index.actions
-        self.links = self.index.links
+        self.index = None
+        self.actions = {}
+        self.links = {}
         self.auth = None
-        self.cms_index = None
+        self._cms_index = None
         self.logged_in = False
-        if email and password:
-            self.login(email, password)
-            if self.logged_in:
-                self.cms_index = self.get_cms(self.index.links.get('cms_index.v2'))
+        if not (email and password and self.restore(email)):
+            self.set_index(self.session.get(self.api_url + self.index_path).json())
+            if email and password:
+                self.login(email, password)
+
+    @property
+    def cms_index(self):
+        """
+        The cms_index.v2 document, fetched on first use unless the index cache had it
+        """
+        if self._cms_index is None and self.logged_in:
+            cms_index_json = self.get_cms(self.index.links.get('cms_index.v2'), match_type=False)
+            if type(cms_index_json) != dict:
+                return cms_index_json
+            self._cms_index = vrv_json_hook(cms_index_json)
+            self.save_index(self.index, cms_index_json)
+        return self._cms_index
+
+    @cms_index.setter
+    def cms_index(self, cms_index):
+        self._cms_index = cms_index
+
+    @property
+    def session(self):
+        """
+        The OAuth1Session of the thread that made this VRV, created on first use so a client whose requests
+        are all answered elsewhere never builds one
+        """
+        if self._session is None:
+            self._session = self._new_session()
+        return self._session
+
+    def _new_session(self):
+        """
+        :return: an OAuth1Session carrying the current token, if there is one
+        """
+        # requests is slow to import, routes that never go online don't pay for it
+        from requests_oauthlib import OAuth1Session
+        session = OAuth1Session(self._oauthkey,
+                                client_secret=self._oauthsecret)
+        session.headers = dict(HEADERS)
+        session.auth.client.resource_owner_key = self._token
+        session.auth.client.resource_owner_secret = self._token_secret
+        return session
+
+    def http(self):
+        """
+        requests sessions are not safe to share between threads, so every worker thread gets its own
+        copy, recreated whenever the token changes
+        :return: the OAuth1Session for the calling thread
+        """
+        if threading.current_thread() is self._owner:
+            return self.session
+        session = getattr(self._local, 'session', None)
+        if session is None or session.auth.client.resource_owner_key != self._token:
+            session = self._new_session()
+            self._local.session = session
+        return session
+
+    def lend_session(self, session=None):
+        """
+        Make the calling thread use session for its requests, lets servers with short lived handler
+        threads keep their connections open
+        :return: the session the thread used until now or None
+        """
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        return previous
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = WorkerPool(self.workers)
+        return self._pool
+
+    def set_index(self, index_json, signing_policies=None):
+        self.index = Index(index_json, signing_policies)
+        self.actions = self.index.actions
+        self.links = self.index.links
+
+    def save_index(self, index, cms_index_json=None):
+        """
+        Write the core and CMS index documents to the index cache
+        :param index: an authenticated Index
+        :param cms_index_json: the raw cms_index.v2 document, if it was fetched
+        """
+        if self.index_cache and self.auth and index.expires:
+            self.index_cache.put(self.auth['account_id'], index.response, index.signing_policies,
+                                 cms_index_json, index.expires)
+
+    def load_index(self):
+        """
+        Restore the core and CMS index from the index cache
+        :return: True if a cached copy that is not about to expire was found
+        """
+        if not (self.index_cache and self.auth):
+            return False
+        cached = self.index_cache.get(self.auth['account_id'], INDEX_EXPIRY_MARGIN)
+        if not cached:
+            return False
+        self.set_index(cached['index'], cached['signing_policies'])
+        if cached.get('cms_index'):
+            self.cms_index = vrv_json_hook(cached['cms_index'])
+        if cached['expires'] - time.time() < INDEX_REFRESH_WINDOW:
+            self.refresh_index(background=True)
+        return True
+
+    def refresh_index(self, background=False):
+        """
+        Fetch fresh copies of the core and CMS index and store them in the index cache
+        The live session keeps using the index it already has
+        :param background: run the fetch on a separate thread with its own session
+        """
+        if background:
+            worker = threading.Thread(target=self.refresh_index)
+            worker.start()
+            return worker
+        session = self._new_session()
+        response = session.get(self.api_url + self.index_path)
+        if response.status_code != 200:
+            return None
+        index = Index(response.json())
+        cms_response = session.get(self.api_url + self.sign_path(index.links.get('cms_index.v2'), index))
+        if cms_response.status_code == 200:
+            self.save_index(index, cms_response.json())
+        return index
+
+    def _set_token(self, token=None, token_secret=None):
+        self._token = token
+        self._token_secret = token_secret
+        if self._session is not None:
+            self._session.auth.client.resource_owner_key = token
+            self._session.auth.client.resource_owner_secret = token_secret
+
+    def restore(self, email):
+        """
+        Reuse a stored OAuth token instead of logging in again
+        With a fresh cached index no request is made and a rejected token shows up as a 401 in the first
+        authorized request, which logs in again, otherwise the authenticated index fetch doubles as the token check
+        :param email: account to restore
+        :return: True if the stored token was accepted
+        """
+        if not self.store:
+            return False
+        auth = self.store.get(email)
+        if not auth:
+            return False
+        self._set_token(auth['oauth_token'], auth['oauth_token_secret'])
+        self.auth = auth
+        if self.load_index():
+            self.logged_in = True
+            return True
+        response = self.session.get(self.api_url + self.index_path)
+        if response.status_code != 200:
+            if response.status_code in (401, 403):
+                self.store.clear()
+            self._set_token()
+            self.auth = None
+            return False
+        self.set_index(response.json())
+        self.save_index(self.index)
+        self.logged_in = True
+        return True
 
     def login(self, email=None, password=None):
+        actions = self.actions
+        if 'authenticate_by_credentials' not in actions:
+            actions = Index(self.session.get(self.api_url + self.index_path).json()).actions
         j = {'email': email, 'password': password}
-        self.auth = self.session.post(self.api_url + self.actions['authenticate_by_credentials'], j).json()
+        self.auth = self.session.post(self.api_url + actions['authenticate_by_credentials'], j).json()
         try:
-            self.session.auth.client.resource_owner_key = self.auth['oauth_token']
-            self.session.auth.client.resource_owner_secret = self.auth['oauth_token_secret']
-            self.index = Index(self.session.get(self.api_url + self.index_path).json())
+            self._set_token(self.auth['oauth_token'], self.auth['oauth_token_secret'])
+            self.set_index(self.session.get(self.api_url + self.index_path).json())
             self.logged_in = True
         except:
             self.logged_in = False
-        
-    def get_cms(self, path, match_type=True):
+        if self.logged_in and self.store:
+            self.store.put(email, self.auth)
+        if self.logged_in:
+            # the cms_index is only fetched once a route needs it
+            self.save_index(self.index)
+
+    def relogin(self, rejected_token=None):
+        """
+        Called when the API rejects the stored token part way through a run
+        :param rejected_token: the token that was rejected, if another thread already replaced it
+                               no new login is made
+        :return: True if a fresh token was obtained
+        """
+        with self._login_lock:
+            if rejected_token and self._token != rejected_token:
+                return self.logged_in
+            return self._relogin()
+
+    def _relogin(self):
+        if self.store:
+            self.store.clear()
+        if self.index_cache:
+            self.index_cache.clear()
+        if not (self._email and self._password):
+            return False
+        self._set_token()
+        self.login(self._email, self._password)
+        return self.logged_in
+
+    def authorized(self, request, retry=True):
+        """
+        Make a request with the calling thread's session, logging in again and repeating it once if the
+        token is rejected
+        :param request: function sending the request with the session it is given
+        :param retry: log in again on a 401, otherwise the 401 is returned as is
+        :return: the requests response
+        """
+        token = self._token
+        response = request(self.http())
+        if response.status_code == 401 and retry and self.relogin(token):
+            response = request(self.http())
+        return response
+
+    @property
+    def cms_url(self):
+        """
+        :return: CMS base path that resource paths like series/<id> are appended to
+        """
+        return self.index.links['cms_index.v2'].rstrip('index')
+
+    def get_cms(self, path, match_type=True, retry=True, use_cache=True):
         """
         :param path:
         :param match_type: use vrv_json_hook after retrieval
+        :param retry: log in again and repeat the request once if the token is rejected
+        :param use_cache: allow the response cache or a recent identical request to answer, and the response
+            cache to store this request
         :return: a request that has the CMS args attached
         """
-        #print("path is",path)
-        #print("avail policies:",self.index.signing_policies.keys())
-        #print("index is",self.index.response)
-        active_policy = None
-        for sign_path in self.index.signing_policies:
-            if sign_path in path:
-                active_policy = self.index.signing_policies[sign_path]
-        if active_policy:
-            pass
-            #print(active_policy)
+        # concurrent requests for a path share one request and one hydrated result, as do requests shortly
+        # after it unless the path is volatile like the watchlist
+        key = (ResponseCache.key(path), match_type)
+        linger = COALESCE_WINDOW if use_cache else 0
+        for fragment in VOLATILE_PATHS:
+            if fragment in path:
+                linger = 0
+        result = self.flights.do(key, self._get_cms, (path, match_type, retry, use_cache), linger)
+        if not isinstance(result, (VRVResponse, dict)):
+            self.flights.forget(key)
+        return result
+
+    def _get_cms(self, path, match_type=True, retry=True, use_cache=True):
+        cached = None
+        headers = {}
+        use_cache = use_cache and self.cache and self.cache.cacheable(path)
+        if use_cache:
+            cached = self.cache.get(path)
+            if cached and cached['fresh']:
+                return self._hydrate(cached['body'], match_type)
+            elif cached:
+                headers = self.cache.validators(cached)
+        # signed again on a retry, a new login may bring new policies
+        response = self.authorized(lambda session: session.get(self.api_url + self.sign_path(path), headers=headers),
+                                   retry)
+        if response.status_code == 304 and cached:
+            self.cache.touch(path, cached['rclass'])
+            return self._hydrate(cached['body'], match_type)
+        if response.status_code == 200:
+            body = response.json()
+            if use_cache:
+                self.cache.put(path, body, response.headers)
+            return self._hydrate(body, match_type)
         else:
-            for sign_path in self.index.signing_policies:
-                 if 'disc/private' in sign_path:
-                     active_policy = self.index.signing_policies[sign_path]
-            #print("Couldn't get active policy, defaulting to disc/private")
-        expires_str = active_policy['expires'].split('+')[0]
-        expires_dt = time.strptime(expires_str,'%Y-%m-%dT%H:%M:%S')
-        expires_ts = int(time.mktime(expires_dt))
-        policy = active_policy['Policy']
-        signature = active_policy['Signature']
-        kp_id = active_policy['Key-Pair-Id']
-        new_params = "Policy={}&Signature={}&Key-Pair-Id={}&Expires={}&endpoint_expires={}".format(policy,signature,kp_id,expires_ts,expires_ts)
+            return response
 
-        if '?' not in path:
-            path += '?' + new_params
+    def get_cms_many(self, paths, match_type=True):
+        """
+        Run get_cms for many paths at once on the session's worker pool
+        :param paths: CMS paths without signing arguments
+        :param match_type: use vrv_json_hook after retrieval
+        :return: list in the order of paths, each entry is what get_cms returned or the exception it raised
+        """
+        return self.pool.map(lambda path: self.get_cms(path, match_type), paths)
+
+    @staticmethod
+    def _hydrate(body, match_type):
+        if match_type:
+            return vrv_json_hook(body)
         else:
-            path += '&' + new_params
-        response = self.session.get(self.api_url + path)
+            return body
+
+    def sign_path(self, path, index=None):
+        """
+        :param path: CMS path without signing arguments
+        :param index: Index holding the signing policies, defaults to the session index
+        :return: path with the CMS signing arguments attached
+        """
+        if not index:
+            index = self.index
+        return index.signer.sign(path)
+
+    def get_play_heads(self, content_ids, chunk_size=50):
+        """
+        Fetch play heads for many episodes or movies with as few requests as possible
+        :param content_ids: ids of the episodes/movies
+        :param chunk_size: most ids sent in one request
+        :return: dictionary of content_id to PlayHead, or to None for ids the API says have no play head,
+            ids whose request failed are left out
+        """
+        play_heads = dict()
+        content_ids = [x for x in content_ids if x]
+        for start in range(0, len(content_ids), chunk_size):
+            chunk = content_ids[start:start + chunk_size]
+            request_string = '/core/accounts/{}/playheads?mode=content&content_ids={}'.format(
+                self.auth['account_id'], quote(','.join(chunk)))
+            collection = self.get_core(request_string)
+            if not isinstance(collection, VRVResponse):
+                continue
+            play_heads.update(dict.fromkeys(chunk))
+            for play_head in getattr(collection, 'items', []):
+                play_heads[play_head.content_id] = play_head
+        return play_heads
+
+    def post_play_head(self, content_id, position):
+        """
+        Save how far into an episode or movie the user got
+        :param position: seconds into the video
+        :return: the requests response
+        """
+        post_url = '{}/core/accounts/{}/playheads'.format(self.api_url, self.auth['account_id'])
+        return self.authorized(lambda session: session.post(post_url, data={'content_id': content_id,
+                                                                             'playhead': position}))
+
+    def get_core(self, path, match_type=True):
+        """
+        GET an unsigned core API path such as the watchlist
+        :param path: path below api_url
+        :param match_type: use vrv_json_hook after retrieval
+        """
+        response = self.authorized(lambda session: session.get(self.api_url + path))
         if response.status_code == 200:
-            if match_type:
-                return vrv_json_hook(response.json())
-            else:
-                return response.json()
+            return self._hydrate(response.json(), match_type)
         else:
             return response
 
+    def paginate(self, path, fetch=None, prefetch=True, max_pages=None):
+        """
+        :param path: first page of a collection
+        :param fetch: function loading a page, defaults to get_cms
+        :param prefetch: load the next page in the background while the current one is consumed
+        :param max_pages: stop after this many pages
+        :return: a Paginator yielding the items of every page
+        """
+        return Paginator(self, path, fetch or self.get_cms, prefetch, max_pages)
+
+    def get_stale(self, path, fetch=None, match_type=True):
+        """
+        Stale-while-revalidate read: answer from the response cache even if the entry expired, and refresh
+        expired entries on a background thread for the next caller
+        Volatile paths like the watchlist are kept for this as well, but only ever served stale.
+        :param path: path for fetch
+        :param fetch: function loading path, called with match_type=False, defaults to get_cms
+        :param match_type: use vrv_json_hook after retrieval
+        :return: tuple of the result and the age in seconds of the cached copy, None if it was fetched now
+        """
+        fetch = fetch or self.get_cms
+        entry = self.cache.get(path) if self.cache else None
+        if entry is None:
+            body = self._revalidate(path, fetch)
+            if type(body) == dict:
+                return self._hydrate(body, match_type), None
+            return body, None
+        if not entry['fresh']:
+            threading.Thread(target=self._revalidate, args=(path, fetch)).start()
+        return self._hydrate(entry['body'], match_type), time.time() - entry['stored']
+
+    def _revalidate(self, path, fetch):
+        body = fetch(path, match_type=False)
+        if self.cache and type(body) == dict:
+            rclass = body.get('__class__')
+            if not self.cache.cacheable(path) or self.cache.ttl(rclass) <= 0:
+                self.cache.put(path, body, keep=True)
+        return body
+
+    def watchlist_path(self, page_length=20, page=1):
+        return '{accounts}/{uid}/watchlist?page_size={length}&page={page}&version=v2'.format(
+            accounts=self.links.get('accounts'), uid=self.auth['account_id'], length=page_length, page=page)
+
     def get_watchlist(self, page_length=20, page=1):
-        url = '{api}{accounts}/{uid}/watchlist?page_size={length}&page={page}&version=v2'.format(
-            api=self.api_url, accounts=self.links.get('accounts'),
-            uid=self.auth['account_id'], length=page_length, page=page)
-        return vrv_json_hook(self.session.get(url).json())
+        return self.get_core(self.watchlist_path(page_length, page))
 
     def add_to_watchlist(self, ref_id):
         url = '{api}{accounts}/{uid}/watchlist'.format(api=self.api_url,
                                                        accounts=self.links.get('accounts'), uid=self.auth['account_id'])
         data = {'ref_id': ref_id}
-        ret_data = self.session.post(url, data=data)
+        ret_data = self.authorized(lambda session: session.post(url, data=data))
+        if self.cache:
+            self.cache.forget('/watchlist')
         if ret_data:
             return ret_data.status_code == 200
         else:
@@ -134,71 +499,260 @@ class VRV(object):
                                                              accounts=self.links.get('accounts'),
                                                              uid=self.auth['account_id'],
                                                              wid=wid)
-        ret_data = self.session.delete(url)
+        ret_data = self.authorized(lambda session: session.delete(url))
+        if self.cache:
+            self.cache.forget('/watchlist')
         if ret_data:
             return ret_data.status_code == 200
         else:
             return False
 
 
+class Paginator(object):
+    """
+    Iterates over the items of a collection that is split into pages linked by continuation or next
+    While the items of one page are consumed the next page is already loading on its own thread.
+    When max_pages cuts the walk short the page after the last one is still prefetched if the
+    response cache can keep it, so following next_path later is answered from disk.
+    """
+
+    def __init__(self, vrv_session, path, fetch, prefetch=True, max_pages=None):
+        self.vrv_session = vrv_session
+        self.path = path
+        self.fetch = fetch
+        self.prefetch = prefetch
+        self.max_pages = max_pages
+        self.pages = 0
+        self.next_path = None
+        self.first_page = None
+
+    def _start(self, path, fetch):
+        task = Task(fetch, (path,))
+        thread = threading.Thread(target=task.run)
+        thread.start()
+        return task
+
+    def _prefetcher(self, path):
+        """
+        :return: function to load path with ahead of time, None if prefetching it is of no use
+        """
+        if not self.prefetch:
+            return None
+        if self.max_pages is None or self.pages < self.max_pages:
+            return self.fetch
+        # the page past the last one is only read by a later run, get_cms leaves it in the response cache
+        # whatever fetch the pages of this walk come from
+        cache = self.vrv_session.cache
+        if cache and cache.cacheable(path):
+            return self.vrv_session.get_cms
+        return None
+
+    def __iter__(self):
+        page = self.fetch(self.path)
+        self.first_page = page
+        while isinstance(page, (VRVResponse, dict)):
+            self.pages += 1
+            if isinstance(page, dict):
+                # fetched with match_type=False
+                links = process_links(page.get('__links__'))
+                items = page.get('items')
+            else:
+                links = page.links
+                items = getattr(page, 'items', None)
+            self.next_path = links.get('continuation') or links.get('next')
+            task = None
+            prefetcher = self.next_path and self._prefetcher(self.next_path)
+            if prefetcher:
+                task = self._start(self.next_path, prefetcher)
+            for item in items or []:
+                yield item
+            if not self.next_path or (self.max_pages is not None and self.pages >= self.max_pages):
+                return
+            if task:
+                page = task.result()
+            else:
+                page = self.fetch(self.next_path)
+            if isinstance(page, Exception):
+                return
+
+
+class EntityMemo(object):
+    """
+    Memo of hydrated CMS entities such as the parent series of an episode
+    Lives as long as the VRV session; persistence across runs comes from the response cache
+    """
+
+    def __init__(self, vrv_session, persist=True):
+        """
+        :param vrv_session: VRV instance used for fetching
+        :param persist: let fetches go through the session's response cache
+        """
+        self.vrv_session = vrv_session
+        self.persist = persist
+        self.entities = dict()
+        # a Catalog consulted before going to the network
+        self.catalog = None
+
+    def get(self, kind, entity_id):
+        """
+        :param kind: CMS collection, e.g. series or movie_listings
+        :param entity_id: id of the entity
+        :return: the hydrated entity, or the failed response
+        """
+        key = (kind, entity_id)
+        if key in self.entities:
+            return self.entities[key]
+        if self.catalog:
+            entity = self.catalog.entity(kind, entity_id)
+            if entity:
+                self.entities[key] = entity
+                return entity
+        entity = self.vrv_session.get_cms(self.vrv_session.cms_url + kind + '/' + entity_id,
+                                          use_cache=self.persist)
+        if isinstance(entity, VRVResponse):
+            self.entities[key] = entity
+        return entity
+
+    def prefetch(self, kind, entity_ids):
+        """
+        Fetch every entity that isn't memoized yet in parallel
+        :param kind: CMS collection, e.g. series or movie_listings
+        :param entity_ids: ids to fetch, duplicates and None are skipped
+        """
+        missing = []
+        for entity_id in entity_ids:
+            if entity_id and (kind, entity_id) not in self.entities and entity_id not in missing:
+                missing.append(entity_id)
+        if len(missing) > 1:
+            self.vrv_session.pool.map(lambda entity_id: self.get(kind, entity_id), missing)
+        elif missing:
+            self.get(kind, missing[0])
+
+    def series(self, series_id):
+        return self.get('series', series_id)
+
+    def movie_listing(self, listing_id):
+        return self.get('movie_listings', listing_id)
+
+    def clear(self):
+        self.entities.clear()
+
+
+class lazy_attribute(object):
+    """
+    Decorator for a method that is turned into an attribute on first access
+    The value is kept in the slot named like the method with a leading underscore
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.slot = '_' + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
+# __class__ values to the VRVResponse subclass that hydrates them, filled in by register
+RESPONSE_CLASSES = dict()
+
+
+def register(*rclasses):
+    """
+    Class decorator adding a VRVResponse subclass to RESPONSE_CLASSES
+    :param rclasses: the __class__ values the subclass handles
+    """
+    def decorator(cls):
+        for rclass in rclasses:
+            RESPONSE_CLASSES[rclass] = cls
+        return cls
+    return decorator
+
+
 class VRVResponse(object):
     """
     A base class for VRV responses
+    links, actions, images and description are worked out on first access
     """
+    __slots__ = ('response', 'href', 'rclass', '_raw_links', '_raw_actions', '_raw_images', '_raw_description',
+                 '_links', '_actions', '_images', '_description')
+
+    # keep the whole response dictionary in .response, turn off to halve the memory of large pages
+    keep_raw = True
+    status_code = 200
 
     def __init__(self, response):
-        self.response = response
+        if self.keep_raw:
+            self.response = response
+        else:
+            self.response = None
         self.href = response.get('__href__')
-        self.links = process_links(response.get('__links__'))
-        self.actions = process_links(response.get('__actions__'))
         self.rclass = response.get('__class__')
-        self.status_code = 200
-        if 'images' in response.keys() and response.get('images'):
-            self.images = Images(response.get('images'))
+        self._raw_links = response.get('__links__')
+        self._raw_actions = response.get('__actions__')
+        self._raw_images = response.get('images')
+        self._raw_description = response.get('description')
+
+    @lazy_attribute
+    def links(self):
+        return process_links(self._raw_links)
+
+    @lazy_attribute
+    def actions(self):
+        return process_links(self._raw_actions)
+
+    @lazy_attribute
+    def images(self):
+        if self._raw_images:
+            return Images(self._raw_images)
         else:
-            self.images = None
+            return None
+
+    @lazy_attribute
+    def description(self):
+        return (self._raw_description or u'').encode('utf-8')
 
     def __repr__(self):
         return u'<VRVResponse: {}>'.format(self.rclass)
 
 
+@register('collection')
 class Collection(VRVResponse):
+    __slots__ = ('items',)
+
     def __init__(self, response):
         super(Collection, self).__init__(response)
         # self.resource_key = response.get('__resource_key__')
         self.items = [vrv_json_hook(x) for x in response.get('items')]
 
-    def get_play_heads(self, vrv_session):
-        ids = []
-        for i in self.items:
-            if type(i) == Episode:
-                ids += [i.id]
-        id_string = ''
-        if ids:
-            for i in ids:
-                id_string += '{},'.format(i)
-            id_string = quote(id_string[0:-1])  # Remove trailing , and encode , to url format
-            request_string = '/core/accounts/{}' \
-                             '/playheads?mode=content&content_ids={}'.format(vrv_session.auth['account_id'], id_string)
-            return vrv_json_hook(vrv_session.session.get(vrv_session.api_url + request_string).json())
-        else:
-            return None
-
 
+@register('season')
 class Season(VRVResponse):
+    __slots__ = ('id', 'channel', 'is_complete', 'is_mature', 'subbed', 'dubbed', 'series_id', 'title',
+                 'season_number')
+
     def __init__(self, response):
         super(Season, self).__init__(response)
         self.id = response.get('id')
         self.channel = response.get('channel_id')
         self.is_complete = response.get('is_complete')
-        self.description = response.get('description').encode('utf-8')
         self.is_mature = response.get('is_mature')
         self.subbed = response.get('is_subbed')
         self.dubbed = response.get('is_dubbed')
         self.series_id = response.get('series_id')
         self.title = response.get('title')
         self.season_number = response.get('season_number')
-        self.episodes_path = self.links.get('season/episodes')
+
+    @property
+    def episodes_path(self):
+        return self.links.get('season/episodes')
 
     def kodi_info(self):
         """
@@ -216,17 +770,22 @@ class Season(VRVResponse):
         return u'<Season: {}>'.format(self.title)
 
 
+@register('movie_listing')
 class MovieListing(VRVResponse):
+    __slots__ = ('id', 'channel', 'is_mature', 'subbed', 'dubbed', 'title')
+
     def __init__(self, response):
         super(MovieListing, self).__init__(response)
         self.id = response.get('id')
         self.channel = response.get('channel_id')
-        self.description = response.get('description').encode('utf-8')
         self.is_mature = response.get('is_mature')
         self.subbed = response.get('is_subbed')
         self.dubbed = response.get('is_dubbed')
         self.title = response.get('title')
-        self.movies_path = self.links.get('movie_listing/movies')
+
+    @property
+    def movies_path(self):
+        return self.links.get('movie_listing/movies')
 
     def __repr__(self):
         return u'<MovieListing: {}>'.format(self.title)
@@ -243,12 +802,16 @@ class MovieListing(VRVResponse):
         }
 
 
+@register('episode')
 class Episode(VRVResponse):
+    __slots__ = ('title', 'media_type', 'duration_ms', 'episode_air_date', 'subbed', 'dubbed', 'episode_number',
+                 'series_title', 'season_number', 'is_mature', 'id', 'series_id', 'available_date',
+                 'next_episode_id')
+
     def __init__(self, response):
         super(Episode, self).__init__(response)
         self.title = response.get('title')
         self.media_type = response.get('media_type')
-        self.description = response.get('description').encode('utf-8')
         self.duration_ms = response.get('duration_ms')
         self.episode_air_date = response.get('episode_air_date')
         self.subbed = response.get('is_subbed')
@@ -257,14 +820,14 @@ class Episode(VRVResponse):
         self.series_title = response.get('series_title')
         self.season_number = response.get('season_number')
         self.is_mature = response.get('is_mature')
-        self.streams = self.links.get('streams')
         self.id = response.get('id')
         self.series_id = response.get('series_id')
         self.available_date = response.get('available_date')
-        if 'next_episode_id' in response.keys():
-            self.next_episode_id = response.get('next_episode_id')
-        else:
-            self.next_episode_id = None
+        self.next_episode_id = response.get('next_episode_id')
+
+    @property
+    def streams(self):
+        return self.links.get('streams')
 
     def kodi_info(self):
         """
@@ -284,9 +847,7 @@ class Episode(VRVResponse):
         }
 
     def post_play_head(self, vrv_session, position):
-        post_url = '{}/core/accounts/{}/playheads'.format(vrv_session.api_url, vrv_session.auth['account_id'])
-        post_data = {'content_id': self.id, 'playhead': position}
-        vrv_session.session.post(post_url, data=post_data)
+        vrv_session.post_play_head(self.id, position)
 
     def get_play_head(self, vrv_session):
         """
@@ -294,33 +855,29 @@ class Episode(VRVResponse):
         :param vrv_session:
         :return: Either None or a PlayHead object
         """
-        request_string = '/core/accounts/{}' \
-                         '/playheads?mode=content&content_ids={}'.format(vrv_session.auth['account_id'], self.id)
-        play_head_collection = vrv_json_hook(vrv_session.session.get(vrv_session.api_url + request_string).json())
-        if play_head_collection.items:
-            return play_head_collection.items[0]
-        else:
-            return None
+        return vrv_session.get_play_heads([self.id]).get(self.id)
 
     def __repr__(self):
         return u'<Episode: {}: {}>'.format(self.title, self.series_title)
 
 
+@register('movie')
 class Movie(VRVResponse):
+    __slots__ = ('title', 'media_type', 'duration_ms', 'is_mature', 'id', 'listing_id', 'next_episode_id')
+
     def __init__(self, response):
         super(Movie, self).__init__(response)
         self.title = response.get('title')
         self.media_type = response.get('media_type')
-        self.description = response.get('description').encode('utf-8')
         self.duration_ms = response.get('duration_ms')
         self.is_mature = response.get('is_mature')
-        self.streams = self.links.get('streams')
         self.id = response.get('id')
         self.listing_id = response.get('listing_id')
-        if 'next_episode_id' in response.keys():
-            self.next_episode_id = response.get('next_episode_id')
-        else:
-            self.next_episode_id = None
+        self.next_episode_id = response.get('next_episode_id')
+
+    @property
+    def streams(self):
+        return self.links.get('streams')
 
     def kodi_info(self):
         """
@@ -335,9 +892,7 @@ class Movie(VRVResponse):
         }
 
     def post_play_head(self, vrv_session, position):
-        post_url = '{}/core/accounts/{}/playheads'.format(vrv_session.api_url, vrv_session.auth['account_id'])
-        post_data = {'content_id': self.id, 'playhead': position}
-        vrv_session.session.post(post_url, data=post_data)
+        vrv_session.post_play_head(self.id, position)
 
     def get_play_head(self, vrv_session):
         """
@@ -345,19 +900,16 @@ class Movie(VRVResponse):
         :param vrv_session:
         :return: Either None or a PlayHead object
         """
-        request_string = '/core/accounts/{}' \
-                         '/playheads?mode=content&content_ids={}'.format(vrv_session.auth['account_id'], self.id)
-        play_head_collection = vrv_json_hook(vrv_session.session.get(vrv_session.api_url + request_string).json())
-        if play_head_collection.items:
-            return play_head_collection.items[0]
-        else:
-            return None
+        return vrv_session.get_play_heads([self.id]).get(self.id)
 
     def __repr__(self):
         return u'<Movie: {}>'.format(self.title)
 
 
+@register('video_streams')
 class VideoStreams(VRVResponse):
+    __slots__ = ('hls', 'hardsub_locale', 'en_subtitle')
+
     def __init__(self, response):
         stream_key = 'adaptive_hls'
         # stream_key = 'multitrack_adaptive_hls_v2'
@@ -371,37 +923,135 @@ class VideoStreams(VRVResponse):
             self.en_subtitle = None
 
 
+@register('index')
 class Index(VRVResponse):
-    def __init__(self, response):
+    __slots__ = ('cms_signing', 'signing_policies', 'signer')
+
+    # the index cache stores the raw document
+    keep_raw = True
+
+    def __init__(self, response, signing_policies=None):
+        """
+        :param signing_policies: already parsed signing policies, skips parse_policy
+        """
         super(Index, self).__init__(response)
         self.cms_signing = response.get('cms_signing')
-        self.signing_policies = self.parse_policy(response.get('signing_policies'))
-    
+        if signing_policies is None:
+            signing_policies = self.parse_policy(response.get('signing_policies'))
+        self.signing_policies = signing_policies
+        self.signer = CmsSigner(self.signing_policies)
+
+    @property
+    def expires(self):
+        """
+        :return: UTC timestamp of the earliest signing policy expiry or None
+        """
+        stamps = self.signer.expiries.values()
+        if stamps:
+            return min(stamps)
+        else:
+            return None
+
     @staticmethod
     def parse_policy(policy_list):
         sign_dict = dict()
         if policy_list:
             for subd in policy_list:
                 path = subd.get('path')
+                if not path or 'name' not in subd:
+                    continue
                 if 'v*' in path:
                     path = path.replace('v*','v2')
 
                 if path in sign_dict:
-                    sign_dict[path][subd['name']] = subd['value']
-                    sign_dict[path]['expires'] = subd['expires']
+                    sign_dict[path][subd['name']] = subd.get('value')
+                    sign_dict[path]['expires'] = subd.get('expires')
                 else:
                     sign_dict[path] = dict()
-                    sign_dict[path][subd['name']] = subd['value']
-                    sign_dict[path]['expires'] = subd['expires']
+                    sign_dict[path][subd['name']] = subd.get('value')
+                    sign_dict[path]['expires'] = subd.get('expires')
         return sign_dict
 
 
+class CmsSigner(object):
+    """
+    Signs CMS paths with the policies from an Index
+    The query suffix of every policy is rendered once and policies are looked up in a trie of path
+    segments, so the longest matching policy path always wins
+    """
+
+    def __init__(self, signing_policies):
+        self.suffixes = dict()
+        # UTC expiry timestamp by policy path, for the policies that could be used
+        self.expiries = dict()
+        self.trie = dict()
+        self.default = None
+        for sign_path in sorted(signing_policies):
+            active_policy = signing_policies[sign_path]
+            try:
+                expires_ts = parse_expires(active_policy['expires'])
+                self.suffixes[sign_path] = \
+                    "Policy={}&Signature={}&Key-Pair-Id={}&Expires={}&endpoint_expires={}".format(
+                        active_policy['Policy'], active_policy['Signature'], active_policy['Key-Pair-Id'],
+                        expires_ts, expires_ts)
+            except (KeyError, ValueError, AttributeError):
+                # an incomplete policy leaves its paths to a shorter matching policy, or unsigned
+                continue
+            self.expiries[sign_path] = expires_ts
+            node = self.trie
+            for segment in self._segments(sign_path.rstrip('*')):
+                node = node.setdefault(segment, dict())
+            node[None] = sign_path
+            if not self.default and 'disc/private' in sign_path:
+                self.default = sign_path
+
+    @staticmethod
+    def _segments(path):
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        return [x for x in path.split('?')[0].split('/') if x]
+
+    def policy_path(self, path):
+        """
+        :param path: CMS path or full URL
+        :return: the signing policy path that applies, falling back to disc/private
+        """
+        match = None
+        node = self.trie
+        for segment in self._segments(path):
+            node = node.get(segment)
+            if node is None:
+                break
+            match = node.get(None, match)
+        if not match:
+            match = self.default
+        return match
+
+    def sign(self, path):
+        """
+        :param path: CMS path without signing arguments
+        :return: path with the CMS signing arguments attached
+        """
+        sign_path = self.policy_path(path)
+        if not sign_path:
+            return path
+        if '?' not in path:
+            return path + '?' + self.suffixes[sign_path]
+        else:
+            return path + '&' + self.suffixes[sign_path]
+
+
 class DiscIndex(VRVResponse):
+    __slots__ = ()
+
     def __init__(self, response):
         super(DiscIndex, self).__init__(response)
 
 
+@register('watchlist_item')
 class WatchlistItem(VRVResponse):
+    __slots__ = ('panel',)
+
     def __init__(self, response):
         super(WatchlistItem, self).__init__(response)
         self.panel = Panel(response.get('panel'))
@@ -410,12 +1060,13 @@ class WatchlistItem(VRVResponse):
         return u'<WatchlistItem: {}>'.format(self.panel.title)
 
 
+@register('panel')
 class Panel(VRVResponse):
+    __slots__ = ('title', 'id', 'channel_id', 'ptype', 'series_metadata', 'episode_count', 'season_count', 'lang')
+
     def __init__(self, response):
         super(Panel, self).__init__(response)
         self.title = response.get('title')
-        self.description = response.get('description').encode('utf-8')
-        self.resource = self.links.get('resource')
         self.id = response.get('id')
         self.channel_id = response.get('channel_id')
         self.ptype = response.get('type')
@@ -439,6 +1090,10 @@ class Panel(VRVResponse):
         else:
             self.lang = ''
 
+    @property
+    def resource(self):
+        return self.links.get('resource')
+
     def kodi_info(self):
         """
         Function to create a dictionary for Kodi setInfo
@@ -463,11 +1118,13 @@ class Panel(VRVResponse):
         return u'<Panel: {}>'.format(self.title)
 
 
+@register('channel', 'core.channel')
 class Channel(VRVResponse):
+    __slots__ = ('name', 'id', 'cms_id')
+
     def __init__(self, response):
         super(Channel, self).__init__(response)
         self.name = response.get('name', response.get('id'))
-        self.description = response.get('description').encode('utf-8')
         self.id = response.get('id')
         self.cms_id = response.get('cms_id')
 
@@ -475,23 +1132,27 @@ class Channel(VRVResponse):
         return u'<Channel: {}>'.format(self.name)
 
 
+@register('series')
 class Series(VRVResponse):
     """
     A Series object
     Response should be from the href series
     """
+    __slots__ = ('title', 'episode_count', 'keywords', 'season_count', 'channel_id', 'id')
 
     def __init__(self, response):
         super(Series, self).__init__(response)
         self.title = response.get('title')
         self.episode_count = response.get('episode_count')
-        self.description = response.get('description').encode('utf-8')
         self.keywords = response.get('keywords')
         self.season_count = response.get('season_count')
-        self.seasons_href = self.links.get('series/seasons')
         self.channel_id = response.get('channel_id')
         self.id = response.get('id')
 
+    @property
+    def seasons_href(self):
+        return self.links.get('series/seasons')
+
     def kodi_info(self):
         """
         Function to create a dictionary for Kodi setInfo
@@ -508,7 +1169,10 @@ class Series(VRVResponse):
         return u'<Series: {}>'.format(self.title)
 
 
+@register('playhead')
 class PlayHead(VRVResponse):
+    __slots__ = ('completion_status', 'position', 'content_id')
+
     def __init__(self, response):
         super(PlayHead, self).__init__(response)
         self.completion_status = response.get('completion_status')
@@ -520,6 +1184,8 @@ class PlayHead(VRVResponse):
 
 
 class Subtitle(object):
+    __slots__ = ('url', 'format', 'locale')
+
     def __init__(self, response):
         self.url = response.get('url')
         self.format = response.get('format')
@@ -529,35 +1195,54 @@ class Subtitle(object):
 class Images(object):
     """
     Object for containing poster info
+    Poster lists are built on first access
     """
+    __slots__ = ('response', '_wide', '_tall', '_thumbnail')
 
     def __init__(self, response):
-        if 'poster_wide' in response.keys():
-            self.wide = [Poster(i) for i in response.get('poster_wide')[0]]
-            self.largest_wide = self._largest(self.wide)
-            self.medium_wide = self._middle(self.wide)
-        else:
-            self.wide = None
-            self.largest_wide = None
-            self.medium_wide = None
-
-        if 'poster_tall' in response.keys():
-            self.tall = [Poster(i) for i in response.get('poster_tall')[0]]
-            self.largest_tall = self._largest(self.tall)
-            self.medium_tall = self._middle(self.tall)
-        else:
-            self.tall = None
-            self.largest_tall = None
-            self.medium_tall = None
-
-        if 'thumbnail' in response.keys():
-            self.thumbnail = [Poster(i) for i in response.get('thumbnail')[0]]
-            self.largest_thumbnail = self._largest(self.thumbnail)
-            self.medium_thumbnail = self._middle(self.thumbnail)
+        self.response = response
+
+    def _posters(self, key):
+        if key in self.response:
+            return [Poster(i) for i in self.response.get(key)[0]]
         else:
-            self.thumbnail = None
-            self.largest_thumbnail = None
-            self.medium_thumbnail = None
+            return None
+
+    @lazy_attribute
+    def wide(self):
+        return self._posters('poster_wide')
+
+    @lazy_attribute
+    def tall(self):
+        return self._posters('poster_tall')
+
+    @lazy_attribute
+    def thumbnail(self):
+        return self._posters('thumbnail')
+
+    @property
+    def largest_wide(self):
+        return self.wide and self._largest(self.wide)
+
+    @property
+    def medium_wide(self):
+        return self.wide and self._middle(self.wide)
+
+    @property
+    def largest_tall(self):
+        return self.tall and self._largest(self.tall)
+
+    @property
+    def medium_tall(self):
+        return self.tall and self._middle(self.tall)
+
+    @property
+    def largest_thumbnail(self):
+        return self.thumbnail and self._largest(self.thumbnail)
+
+    @property
+    def medium_thumbnail(self):
+        return self.thumbnail and self._middle(self.thumbnail)
 
     @staticmethod
     def _largest(items):
@@ -581,22 +1266,41 @@ class Images(object):
         ls = sorted(items, key=lambda image: image.width)
         return ls[int(len(ls) / 2)]
 
-    def kodi_setart_dict(self):
+    @staticmethod
+    def _fitting(items, width):
+        """
+        :param items: items to pick from
+        :param width: wanted width in pixels
+        :return: the smallest item at least width wide, or the largest one if none is
+        """
+        fitting = [x for x in items if x.width >= width]
+        if fitting:
+            return min(fitting, key=lambda image: image.width)
+        else:
+            return max(items, key=lambda image: image.width)
+
+    def kodi_setart_dict(self, targets=None):
         """
         Helper function for working with ListItem.setArt
+        :param targets: dictionary of art type to wanted width, see ART_TARGETS
+                        without it the middle size of each kind is used
         :return: a dictionary formatted for Kodi
         """
+        if targets:
+            pick = lambda items, atype: self._fitting(items, targets.get(atype, 0)).source
+        else:
+            pick = lambda items, atype: self._middle(items).source
         outdict = {}
         if self.tall:
-            outdict['poster'] = self.medium_tall.source
+            outdict['poster'] = pick(self.tall, 'poster')
         if self.wide:
-            outdict['banner'] = self.medium_wide.source
-            outdict['fanart'] = self.medium_wide.source
+            outdict['banner'] = pick(self.wide, 'banner')
+            outdict['fanart'] = pick(self.wide, 'fanart')
         if self.thumbnail:
-            outdict['thumb'] = self.medium_thumbnail.source
+            outdict['thumb'] = pick(self.thumbnail, 'thumb')
         else:
             if self.tall:
-                outdict['thumb'] = self.medium_tall.source
+                outdict['thumb'] = pick(self.tall, 'thumb')
         return outdict
 
     def __repr__(self):
@@ -607,6 +1311,7 @@ class Poster(object):
     """
     Object that contains posters
     """
+    __slots__ = ('kind', 'width', 'height', 'source')
 
     def __init__(self, poster_data):
         self.kind = poster_data['type']
@@ -618,16 +1323,17 @@ class Poster(object):
         return u'<Poster: {} {}x{}>'.format(self.kind, self.width, self.height)
 
 
+@register('curated_feed')
 class CuratedFeed(VRVResponse):
     """
     Curated Feed class.
     """
+    __slots__ = ('title', 'api_class', 'id', 'items', 'feed_type')
 
     def __init__(self, response):
         super(CuratedFeed, self).__init__(response)
         self.title = response.get('title', 'no title')
         self.api_class = response.get('__class__', 'no class')
-        self.description = response.get('description', '')
         self.id = response.get('id')
         if response.get('items'):
             self.items = [vrv_json_hook(x) for x in response.get('items')]
@@ -641,6 +1347,7 @@ class UnknownType(VRVResponse):
     """
     Catchall class meant for debugging
     """
+    __slots__ = ('title', 'api_class')
 
     def __init__(self, response):
         super(UnknownType, self).__init__(response)
@@ -656,35 +1363,4 @@ def vrv_json_hook(response):
     :param response: A dictionary object that has __class__ key
     :return: matching class for __class__
     """
-    if '__class__' in response:
-        rclass = response.get('__class__')
-        if rclass == 'collection':
-            return Collection(response)
-        elif rclass == 'season':
-            return Season(response)
-        elif rclass == 'movie_listing':
-            return MovieListing(response)
-        elif rclass == 'episode':
-            return Episode(response)
-        elif rclass == 'movie':
-            return Movie(response)
-        elif rclass == 'video_streams':
-            return VideoStreams(response)
-        elif rclass == 'index':
-            return Index(response)
-        elif rclass == 'watchlist_item':
-            return WatchlistItem(response)
-        elif rclass == 'channel' or rclass == 'core.channel':
-            return Channel(response)
-        elif rclass == 'curated_feed':
-            return CuratedFeed(response)
-        elif rclass == 'panel':
-            return Panel(response)
-        elif rclass == 'series':
-            return Series(response)
-        elif rclass == 'playhead':
-            return PlayHead(response)
-        else:
-            return UnknownType(response)
-    else:
-        return UnknownType(response)
+    return RESPONSE_CLASSES.get(response.get('__class__'), UnknownType)(response)
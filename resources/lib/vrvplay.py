@@ -1,29 +1,158 @@
+"""
+vrvplay.py
+Player that follows one playback through Kodi's callbacks instead of polling
+"""
+import time
 import xbmc
-import vrvlib
+
+
+def has_av_started():
+    """
+    :return: True if this Kodi sends onAVStarted, before Leia onPlayBackStarted is the last callback at startup
+    """
+    try:
+        return int(xbmc.getInfoLabel('System.BuildVersion').split('.')[0]) >= 18
+    except ValueError:
+        return False
 
 
 class VRVPlayer(xbmc.Player):
+    """
+    Tracks the position of one playback
+    The position is sampled every sample_interval seconds and on pause and seek events, in between it is
+    extrapolated from the wall clock, so the position at stop is accurate without waking up often.
+    Kodi only delivers the callbacks while the plugin sleeps in waitForAbort, see wait.
+    """
 
-    def __init__(self, session):
+    def __init__(self, resume_at=-1, sample_interval=10, checkpoint=None):
+        """
+        :param resume_at: seconds to seek to once the video is up, -1 to start at the beginning
+        :param sample_interval: seconds between reads of the player's time
+        :param checkpoint: function called with the position after every sample
+        """
         xbmc.Player.__init__(self)
-        self.session = session
-        self.position = 0
+        self.resume_at = resume_at
+        self.sample_interval = sample_interval
+        self.checkpoint = checkpoint
+        self.av_events = has_av_started()
+        self.started = False
+        self.finished = False
+        self.ended = False
+        self.failed = False
+        self.paused = False
+        self.duration = 0
+        self._position = 0
+        self._sampled_at = None
+        self._attached = []
 
-    def onPlayBackStarted(self):
-        while self.isPlaying():
-            xbmc.sleep(500)
+    @property
+    def position(self):
+        """
+        :return: seconds into the video, as of now
+        """
+        position = self._position
+        if self._sampled_at and not self.paused and not self.finished:
+            position += time.time() - self._sampled_at
+        if self.duration:
+            position = min(position, self.duration)
+        return int(position)
 
-        pass
+    def _set_position(self, seconds):
+        self._position = seconds
+        self._sampled_at = time.time()
 
-    def onPlayBackEnded(self):
-        pass
+    def sample(self):
+        """
+        Read the position from the player, keeping the estimate when nothing is playing
+        """
+        try:
+            self._set_position(self.getTime())
+            if not self.duration:
+                self.duration = self.getTotalTime()
+        except RuntimeError:
+            pass
 
-    def onPlayBackStopped(self):
-        xbmc.log("VRVPlayer: Playback stopped at %s" % (self.getTime()), xbmc.LOGNOTICE)
-        pass
+    def _on_started(self):
+        self.started = True
+        if self.resume_at > 0:
+            xbmc.log("VRVPlayer: Seeking to %s" % self.resume_at, xbmc.LOGDEBUG)
+            # the start position given to play() is ignored for these streams
+            self.seekTime(float(self.resume_at))
+            self._set_position(self.resume_at)
+        else:
+            self.sample()
+
+    def onPlayBackStarted(self):
+        if not self.av_events:
+            self._on_started()
+
+    def onAVStarted(self):
+        self._on_started()
+
+    def onPlayBackSeek(self, seek_time, seek_offset):
+        self._set_position(seek_time / 1000.0)
 
     def onPlayBackPaused(self):
-        print("Strted")
+        self.sample()
+        self.paused = True
 
     def onPlayBackResumed(self):
-        print("Strted")
+        self.paused = False
+        self.sample()
+
+    def _on_finished(self):
+        # freeze the extrapolated position, getTime no longer works
+        self._position = self.position
+        self.finished = True
+
+    def onPlayBackStopped(self):
+        self._on_finished()
+        xbmc.log("VRVPlayer: Playback stopped at %s" % self.position, xbmc.LOGNOTICE)
+
+    def onPlayBackEnded(self):
+        self.ended = True
+        if self.duration:
+            self._set_position(self.duration)
+        self._on_finished()
+
+    def onPlayBackError(self):
+        self.failed = True
+        self._on_finished()
+
+    def attach(self, task, apply):
+        """
+        Call apply with the result of a background task once playback started and the task is done
+        :param task: workers.Task, nothing is applied if it ends in an exception
+        """
+        self._attached.append((task, apply))
+
+    def _apply_attached(self):
+        for task, apply in [(task, apply) for task, apply in self._attached if task.done()]:
+            self._attached.remove((task, apply))
+            result = task.result()
+            if not isinstance(result, Exception):
+                apply(result)
+
+    def wait(self, monitor, timeout=30):
+        """
+        Sleep until playback is over, sampling the position now and then and applying attached tasks
+        :param monitor: xbmc.Monitor whose waitForAbort lets the callbacks through
+        :param timeout: seconds playback may take to start
+        :return: True if playback started, position then holds where it stopped
+        """
+        waited = 0
+        while not self.started and not self.finished:
+            if waited >= timeout or monitor.waitForAbort(1):
+                return False
+            waited += 1
+        while not self.finished:
+            self._apply_attached()
+            # check back soon while attached tasks are still running
+            if monitor.waitForAbort(1 if self._attached else self.sample_interval):
+                self._on_finished()
+                break
+            if not self.paused:
+                self.sample()
+                if self.checkpoint:
+                    self.checkpoint(self.position)
+        return self.started
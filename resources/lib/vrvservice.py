@@ -0,0 +1,281 @@
+"""
+vrvservice.py
+Local IPC between the background service, which keeps one warm VRV session, and plugin invocations
+Requests are single JSON lines over a TCP connection to localhost, authenticated with a token that
+the service writes to the profile directory together with its port.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from Queue import Queue, Empty
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+from vrvlib import VRV, vrv_json_hook, INDEX_REFRESH_WINDOW
+from vrvstore import JSONStore
+from catalog import Crawler
+
+
+class ServiceError(Exception):
+    pass
+
+
+class ServiceResponse(object):
+    """
+    Stands in for the requests response of a call that failed inside the service
+    """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = ''
+
+    def json(self):
+        return {}
+
+
+class ServiceHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request.get('token') != self.server.token:
+            reply = {'error': 'bad token'}
+        else:
+            method = getattr(self.server, 'do_' + str(request.get('method')), None)
+            if method is None:
+                reply = {'error': 'unknown method'}
+            else:
+                try:
+                    reply = {'result': self.server.call(method, request.get('args') or [])}
+                except Exception as e:
+                    reply = {'error': repr(e)}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class ServiceServer(ThreadingTCPServer):
+    """
+    Answers plugin requests with the session it was started with
+    Every connection runs on its own short lived thread, the HTTP sessions they use are kept in a pool so
+    their connections to the API stay open between requests.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, vrv_session, info_path, catalog=None):
+        """
+        :param vrv_session: logged in VRV instance
+        :param info_path: file the port and token are written to for the plugin to find
+        :param catalog: optional Catalog whose stale listings plugin runs hand over for refreshing
+        """
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), ServiceHandler)
+        self.vrv_session = vrv_session
+        self.info = JSONStore(info_path)
+        self.token = os.urandom(16).encode('hex')
+        self.sessions = Queue()
+        self.catalog = catalog
+        self.refreshes = Queue()
+        self.pending = set()
+        self._pending_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+        self.info.save({'port': self.server_address[1], 'token': self.token, 'started': int(time.time())})
+        try:
+            os.chmod(info_path, 0o600)
+        except OSError:
+            pass
+
+    def call(self, method, args):
+        try:
+            session = self.sessions.get_nowait()
+        except Empty:
+            session = None
+        self.vrv_session.lend_session(session)
+        try:
+            return method(*args)
+        finally:
+            session = self.vrv_session.lend_session(None)
+            if session is not None:
+                self.sessions.put(session)
+
+    @staticmethod
+    def _reply(result):
+        if type(result) == dict:
+            return {'body': result}
+        return {'status_code': getattr(result, 'status_code', 500)}
+
+    def do_state(self):
+        """
+        :return: what a plugin needs to act as the logged in session
+        """
+        vrv_session = self.vrv_session
+        return {
+            'email': vrv_session._email,
+            'auth': vrv_session.auth,
+            'index': vrv_session.index.response,
+            'signing_policies': vrv_session.index.signing_policies,
+            'cms_index': getattr(vrv_session.cms_index, 'response', None)
+        }
+
+    def do_get_cms(self, path, use_cache=True):
+        return self._reply(self.vrv_session.get_cms(path, match_type=False, use_cache=use_cache))
+
+    def do_get_core(self, path):
+        return self._reply(self.vrv_session.get_core(path, match_type=False))
+
+    def do_stats(self):
+        return self.vrv_session.flights.stats()
+
+    def do_refresh_listing(self, kind, entity_id):
+        """
+        Queue a catalog listing for Crawler.refresh_listing, a listing already waiting is queued once
+        :return: False if the service keeps no catalog
+        """
+        if not self.catalog:
+            return False
+        with self._pending_lock:
+            if (kind, entity_id) not in self.pending:
+                self.pending.add((kind, entity_id))
+                self.refreshes.put((kind, entity_id))
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_listings)
+                self._refresher.start()
+        return True
+
+    def _refresh_listings(self):
+        crawler = Crawler(self.vrv_session, self.catalog, should_stop=self._stopped.is_set)
+        while not self._stopped.is_set():
+            listing = self.refreshes.get()
+            if listing is None:
+                break
+            try:
+                crawler.refresh_listing(*listing)
+            except Exception:
+                pass
+            finally:
+                with self._pending_lock:
+                    self.pending.discard(listing)
+
+    def keep_warm(self):
+        """
+        Swap in a fresh index before the signing policies of the current one run out
+        """
+        expires = self.vrv_session.index.expires
+        if expires and expires - time.time() < INDEX_REFRESH_WINDOW and self.vrv_session.refresh_index():
+            self.vrv_session.load_index()
+
+    def stop(self):
+        self._stopped.set()
+        self.refreshes.put(None)
+        self.info.clear()
+        self.shutdown()
+        self.server_close()
+
+
+class ServiceClient(object):
+    def __init__(self, port, token, timeout=60):
+        self.port = port
+        self.token = token
+        self.timeout = timeout
+
+    @classmethod
+    def from_file(cls, info_path):
+        """
+        :return: a client for the service described in info_path, or None if it isn't running
+        """
+        info = JSONStore(info_path).load()
+        if not (info and info.get('port') and info.get('token')):
+            return None
+        return cls(info['port'], info['token'])
+
+    def call(self, method, *args):
+        """
+        :return: the result of the service's do_<method>
+        """
+        try:
+            conn = socket.create_connection(('127.0.0.1', self.port), self.timeout)
+            try:
+                conn.sendall(json.dumps({'token': self.token, 'method': method, 'args': args}) + '\n')
+                reply = conn.makefile('rb').readline()
+            finally:
+                conn.close()
+            reply = json.loads(reply)
+        except (socket.error, ValueError) as e:
+            raise ServiceError(repr(e))
+        if 'error' in reply:
+            raise ServiceError(reply['error'])
+        return reply.get('result')
+
+
+class RemoteVRV(VRV):
+    """
+    VRV whose CMS and core GETs are made by the service's warm session
+    Login state comes from the service, everything else, caches included, runs in the plugin process.
+    If the service goes away requests are made directly with the same token.
+    """
+
+    def __init__(self, client, state, email=None, password=None, key=None, secret=None, cache=None, workers=4):
+        self.client = client
+        self._state = state
+        super(RemoteVRV, self).__init__(email, password, key, secret, cache=cache, workers=workers)
+
+    @classmethod
+    def connect(cls, info_path, email=None, password=None, key=None, secret=None, cache=None, workers=4):
+        """
+        :param info_path: file the service announces itself in
+        :return: a RemoteVRV, or None if no service for email is running
+        """
+        client = ServiceClient.from_file(info_path)
+        if not client:
+            return None
+        try:
+            state = client.call('state')
+        except ServiceError:
+            return None
+        if not state or state.get('email') != email:
+            return None
+        return cls(client, state, email, password, key, secret, cache=cache, workers=workers)
+
+    def restore(self, email):
+        state = self._state
+        self.auth = state['auth']
+        self._set_token(self.auth['oauth_token'], self.auth['oauth_token_secret'])
+        self.set_index(state['index'], state['signing_policies'])
+        if state.get('cms_index'):
+            self.cms_index = vrv_json_hook(state['cms_index'])
+        self.logged_in = True
+        return True
+
+    def _remote(self, method, path, match_type, *args):
+        try:
+            reply = self.client.call(method, path, *args)
+        except ServiceError:
+            self.client = None
+            return None
+        if 'body' in reply:
+            return self._hydrate(reply['body'], match_type)
+        return ServiceResponse(reply.get('status_code'))
+
+    def _get_cms(self, path, match_type=True, retry=True, use_cache=True):
+        result = self.client and self._remote('get_cms', path, match_type, use_cache)
+        if result is None:
+            return super(RemoteVRV, self)._get_cms(path, match_type, retry, use_cache)
+        return result
+
+    def get_core(self, path, match_type=True):
+        result = self.client and self._remote('get_core', path, match_type)
+        if result is None:
+            return super(RemoteVRV, self).get_core(path, match_type)
+        return result
+
+    def refresh_listing(self, kind, entity_id):
+        """
+        Hand a catalog listing that was served stale to the service to refresh
+        :return: True if the service took it
+        """
+        if not self.client:
+            return False
+        try:
+            return bool(self.client.call('refresh_listing', kind, entity_id))
+        except ServiceError:
+            return False
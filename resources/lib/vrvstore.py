@@ -0,0 +1,128 @@
+"""
+vrvstore.py
+Small JSON stores that live in the addon profile directory
+"""
+import json
+import os
+import time
+
+
+class JSONStore(object):
+    """
+    A dictionary persisted to a single JSON file
+    Writes go to a temporary file first so a killed process never leaves half a file behind
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        :return: the stored dictionary or None if there is nothing usable on disk
+        """
+        try:
+            with open(self.path, 'rb') as fh:
+                data = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        if type(data) == dict:
+            return data
+        else:
+            return None
+
+    def save(self, data):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as fh:
+                json.dump(data, fh)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class CredentialStore(JSONStore):
+    """
+    Keeps the OAuth token pair handed out by authenticate_by_credentials so later
+    plugin invocations can skip the login round trips
+    """
+
+    def get(self, email):
+        """
+        :param email: the account the caller wants to use
+        :return: dict with oauth_token, oauth_token_secret, account_id and login_time or None
+        """
+        data = self.load()
+        if not data or data.get('email') != email:
+            return None
+        if not (data.get('oauth_token') and data.get('oauth_token_secret') and data.get('account_id')):
+            return None
+        return data
+
+    def put(self, email, auth):
+        """
+        :param email: account the token belongs to
+        :param auth: the authenticate_by_credentials response
+        """
+        data = {
+            'email': email,
+            'oauth_token': auth.get('oauth_token'),
+            'oauth_token_secret': auth.get('oauth_token_secret'),
+            'account_id': auth.get('account_id'),
+            'login_time': int(time.time())
+        }
+        if self.save(data):
+            try:
+                os.chmod(self.path, 0o600)
+            except OSError:
+                pass
+        return data
+
+
+class IndexCache(JSONStore):
+    """
+    Keeps the authenticated core index and the cms_index.v2 document until shortly before
+    the earliest signing policy in them expires
+    """
+
+    def get(self, account_id, margin=0):
+        """
+        :param account_id: account the index has to belong to
+        :param margin: seconds before expiry at which the copy is no longer handed out
+        :return: dict with index, signing_policies, cms_index and expires or None, cms_index may be None
+        """
+        data = self.load()
+        if not data or data.get('account_id') != account_id:
+            return None
+        if not (data.get('index') and data.get('signing_policies')):
+            return None
+        if data.get('expires', 0) - margin <= time.time():
+            return None
+        return data
+
+    def put(self, account_id, index, signing_policies, cms_index, expires):
+        """
+        :param account_id: account the index was fetched for
+        :param index: raw core index document
+        :param signing_policies: the index's parsed signing policies
+        :param cms_index: raw cms_index.v2 document or None
+        :param expires: UTC timestamp of the earliest signing policy expiry
+        """
+        data = {
+            'account_id': account_id,
+            'index': index,
+            'signing_policies': signing_policies,
+            'cms_index': cms_index,
+            'expires': expires,
+            'fetched': int(time.time())
+        }
+        self.save(data)
+        return data
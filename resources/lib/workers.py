@@ -0,0 +1,171 @@
+"""
+workers.py
+Small threading helpers: a bounded pool of worker threads and call coalescing
+"""
+import threading
+import time
+from Queue import Queue, Empty
+
+
+class Task(object):
+    """
+    Handle for a function submitted to a WorkerPool
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        :param timeout: seconds to wait, None waits until the task has run
+        :return: what the function returned, or the exception it raised
+        """
+        self.wait(timeout)
+        if self.error is not None:
+            return self.error
+        return self.value
+
+
+class WorkerPool(object):
+    """
+    Runs functions on at most size threads
+    Threads are started on demand and exit after idle seconds without work. They are not daemon
+    threads, Python 2 crashes when daemon threads are still running during interpreter shutdown.
+    Tasks must not wait on other tasks of the same pool, a full pool would deadlock.
+    """
+
+    def __init__(self, size=4, idle=2.0):
+        self.size = size
+        self.idle = idle
+        self.tasks = Queue()
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            wanted = min(self.size, len(self.threads) + self.tasks.qsize())
+            while len(self.threads) < wanted:
+                thread = threading.Thread(target=self._work)
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            try:
+                task = self.tasks.get(timeout=self.idle)
+            except Empty:
+                with self._lock:
+                    if self.tasks.empty():
+                        self.threads.remove(threading.current_thread())
+                        return
+                continue
+            task.run()
+            self.tasks.task_done()
+
+    def submit(self, func, *args):
+        """
+        :return: a Task for func(*args)
+        """
+        task = Task(func, args)
+        self.tasks.put(task)
+        self._start()
+        return task
+
+    def map(self, func, items):
+        """
+        :param func: called once per item
+        :param items: arguments for func
+        :return: results in the order of items, exceptions are returned in place of their result
+        """
+        tasks = [self.submit(func, item) for item in items]
+        return [task.result() for task in tasks]
+
+
+class SingleFlight(object):
+    """
+    Lets calls for the same key share one execution of their function
+    A call that arrives while another one with the same key is running waits for it and gets its result.
+    With a linger time, calls arriving shortly after a successful run get that result as well.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._flights = dict()
+        self._recent = dict()
+
+    def do(self, key, func, args=(), linger=0):
+        """
+        :param key: hashable identifying what func computes
+        :param func: function run if no call for key is in flight
+        :param args: arguments for func
+        :param linger: seconds the result keeps being handed out after func returned, a call with 0 only shares
+            a run that is still in flight and never gets a lingering result
+        :return: what func returned, exceptions are raised in every caller that shared the call
+        """
+        with self._lock:
+            self.calls += 1
+            recent = self._recent.get(key) if linger else None
+            if recent and recent[0] > time.time():
+                self.shared += 1
+                return recent[1]
+            task = self._flights.get(key)
+            owner = task is None
+            if owner:
+                task = Task(func, args)
+                self._flights[key] = task
+            else:
+                self.shared += 1
+        if owner:
+            task.run()
+            with self._lock:
+                del self._flights[key]
+                if linger and task.error is None:
+                    if len(self._recent) > 128:
+                        self._prune()
+                    self._recent[key] = (time.time() + linger, task.value)
+                elif key in self._recent and task.error is None:
+                    # a lingering result older than this run would hand out outdated data
+                    self._recent[key] = (self._recent[key][0], task.value)
+        else:
+            task.wait()
+        if task.error is not None:
+            raise task.error
+        return task.value
+
+    def _prune(self):
+        now = time.time()
+        for key in [key for key, (expires, value) in self._recent.items() if expires <= now]:
+            del self._recent[key]
+
+    def forget(self, key):
+        """
+        Stop handing out the lingering result for key
+        """
+        with self._lock:
+            self._recent.pop(key, None)
+
+    def stats(self):
+        """
+        :return: dict with the number of calls and how many of them were answered by another call
+        """
+        return {'calls': self.calls, 'saved': self.shared}
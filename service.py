@@ -0,0 +1,120 @@
+"""
+service.py
+Background service keeping one logged in VRV session for the plugin to use
+"""
+
+import os
+import threading
+import xbmc
+import xbmcaddon
+
+from resources.lib.vrvlib import VRV
+from resources.lib.vrvstore import CredentialStore, IndexCache
+from resources.lib.httpcache import ResponseCache
+from resources.lib.vrvservice import ServiceServer
+from resources.lib.playheads import PlayheadStore, PlayheadSync
+from resources.lib.catalog import Catalog
+
+_plugId = "plugin.video.vrv"
+
+__plugin__ = "VRV service"
+
+
+def my_log(message, level):
+    xbmc.log("[SERVICE] %s: %s" % (__plugin__, message,), level)
+
+
+class ServiceMonitor(xbmc.Monitor):
+    def __init__(self):
+        xbmc.Monitor.__init__(self)
+        self.settings_changed = False
+
+    def onSettingsChanged(self):
+        self.settings_changed = True
+
+
+def addon_profile():
+    return xbmc.translatePath(xbmcaddon.Addon(id=_plugId).getAddonInfo('profile')).decode("utf-8")
+
+
+def start_server():
+    """
+    :return: a running ServiceServer, or None if the service is disabled or the login failed
+    """
+    settings = xbmcaddon.Addon(id=_plugId)
+    profile = addon_profile()
+    if settings.getSetting('use_service') != 'true':
+        return None
+    username, password = settings.getSetting('vrv_username'), settings.getSetting('vrv_password')
+    if not (username and password):
+        return None
+    if not os.path.exists(profile):
+        os.mkdir(profile)
+    if settings.getSetting('api_cache') == 'true':
+        api_cache_ttl = int(float(settings.getSetting('api_cache_hours') or 24) * 3600)
+        response_cache = ResponseCache(os.path.join(profile, 'responses.db'),
+                                       ttls=dict((rclass, api_cache_ttl) for rclass in
+                                                 ('series', 'movie_listing', 'movie', 'channel', 'core.channel')))
+    else:
+        response_cache = None
+    session = VRV(username, password,
+                  settings.getSetting('oauth_key'),
+                  settings.getSetting('oauth_secret'),
+                  store=CredentialStore(os.path.join(profile, 'credentials.json')),
+                  index_cache=IndexCache(os.path.join(profile, 'index_cache.json')),
+                  cache=response_cache)
+    if not session.logged_in:
+        my_log("Login failed, not serving", xbmc.LOGWARNING)
+        return None
+    catalog = None
+    if settings.getSetting('use_catalog') == 'true':
+        catalog = Catalog(os.path.join(profile, 'catalog.db'))
+    server = ServiceServer(session, os.path.join(profile, 'service.json'), catalog)
+    threading.Thread(target=server.serve_forever).start()
+    my_log("Serving on port {}".format(server.server_address[1]), xbmc.LOGNOTICE)
+    return server
+
+
+def flush_play_heads(sync):
+    """
+    Send the playhead updates plugin runs left behind
+    """
+    try:
+        sent = sync.flush()
+    except Exception as e:
+        my_log("Sending playheads failed: {}".format(e), xbmc.LOGWARNING)
+        return
+    if sent:
+        my_log("Sent {} playhead updates".format(sent), xbmc.LOGDEBUG)
+
+
+def run():
+    monitor = ServiceMonitor()
+    while not monitor.abortRequested():
+        try:
+            server = start_server()
+        except Exception as e:
+            my_log("Could not start: {}".format(e), xbmc.LOGERROR)
+            server = None
+        sync = None
+        if server:
+            sync = PlayheadSync(PlayheadStore(os.path.join(addon_profile(), 'playheads.db')), server.vrv_session)
+            flush_play_heads(sync)
+        monitor.settings_changed = False
+        while not monitor.settings_changed:
+            if monitor.waitForAbort(60):
+                break
+            if server:
+                try:
+                    server.keep_warm()
+                except Exception as e:
+                    my_log("Refreshing the index failed: {}".format(e), xbmc.LOGWARNING)
+                flush_play_heads(sync)
+        if server:
+            my_log("Served {calls} CMS requests, {saved} of them coalesced".format(**server.do_stats()),
+                   xbmc.LOGNOTICE)
+            server.stop()
+
+
+if __name__ == '__main__':
+    run()